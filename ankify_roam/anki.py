@@ -1,27 +1,448 @@
 import json 
 import urllib.request 
+import urllib.error
+import http.client
+import socket
+import threading
 import logging
 import traceback
 import re
+import time
+import hashlib
+import asyncio
+from collections import Counter
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 8765
+API_VERSION = 6
+# Number of notes to send to AnkiConnect in each `multi` request
+DEFAULT_BATCH_SIZE = 100
+# Largest request body to build before splitting a batch into several requests. 
+# Notes with images can be several megabytes each once base64 encoded.
+DEFAULT_MAX_REQUEST_BYTES = 4 * 1024**2
+# Number of requests AsyncAnkiConnectClient sends at once by default
+DEFAULT_MAX_IN_FLIGHT = 4
+# Seconds to wait for AnkiConnect to respond to a request
+DEFAULT_TIMEOUT = 60
+# Number of times to retry a request which couldn't reach AnkiConnect, waiting 
+# DEFAULT_BACKOFF seconds before the first retry and twice as long before each next one
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 30
+# Actions which only read from Anki, so sending them again after a timeout or a 
+# dropped connection can't add a note or media file twice
+READ_ONLY_ACTIONS = {
+    "version", "deckNames", "modelNames", "modelFieldNames", "modelTemplates", "modelStyling", 
+    "findNotes", "findCards", "notesInfo", "cardsInfo", "areSuspended", "getTags", 
+    "getMediaFilesNames", "retrieveMediaFile", "getProfiles",
+}
+
+
+class CircuitBreaker:
+    """Pause requests after AnkiConnect fails several requests in a row
+
+    After `threshold` consecutive failed requests the breaker opens, and requests 
+    wait until `cooldown` seconds have passed since the last failure before trying 
+    again. Once the breaker has been open for more than `max_pause` seconds, 
+    requests made during the cooldown fail straight away with CircuitOpenError, 
+    though one request is still let through after each cooldown to check whether 
+    AnkiConnect has recovered.
+    """
+    def __init__(self, threshold=5, cooldown=10, max_pause=300):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_pause = max_pause
+        self.num_failures = 0
+        self.opened_at = None
+        self.last_failure = None
+        self.num_opened = 0
+        # A breaker can be shared by clients in different threads
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def wait_time(self):
+        "Return the seconds to wait before sending a request"
+        with self._lock:
+            if not self.is_open:
+                return 0
+            now = time.monotonic()
+            wait = max(0, self.last_failure + self.cooldown - now)
+            if wait and now - self.opened_at > self.max_pause:
+                raise CircuitOpenError(f"AnkiConnect has failed every request for {now - self.opened_at:.0f} seconds")
+            return wait
+
+    def record_success(self):
+        with self._lock:
+            if self.is_open:
+                logger.info("AnkiConnect is responding again")
+            self.num_failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.num_failures += 1
+            self.last_failure = time.monotonic()
+            if self.num_failures >= self.threshold and not self.is_open:
+                self.opened_at = self.last_failure
+                self.num_opened += 1
+                logger.warning(f"AnkiConnect failed {self.num_failures} requests in a row, "
+                               f"pausing requests for {self.cooldown} seconds at a time")
+
+
+def _is_read_only(request_dict):
+    "Return whether every action in a request only reads from Anki"
+    if request_dict.get("action") == "multi":
+        return all(_is_read_only(a) for a in request_dict.get("params", {}).get("actions", []))
+    return request_dict.get("action") in READ_ONLY_ACTIONS
+
+def _connection_refused(error):
+    "Return whether a request failed because AnkiConnect refused the connection, before anything was sent"
+    reason = error.reason
+    while isinstance(reason, urllib.error.URLError):
+        reason = reason.reason
+    return isinstance(reason, ConnectionRefusedError)
+
+def _pause_for_breaker(client):
+    "Return how long to wait before a request, counting the time paused in the client's stats"
+    with client._lock:
+        try:
+            wait = client.breaker.wait_time()
+        except CircuitOpenError:
+            client.stats["failed"] += 1
+            raise
+        if wait:
+            client.stats["paused_seconds"] += wait
+    return wait
+
+def _record_success(client):
+    with client._lock:
+        client.breaker.record_success()
+
+def _record_failure(client, attempt, retry, error):
+    """Record a request which couldn't reach AnkiConnect
+
+    Returns the seconds to wait before retrying, or raises the error if the 
+    request shouldn't be retried.
+    """
+    with client._lock:
+        client.breaker.record_failure()
+        if not retry or attempt >= client.retries:
+            client.stats["failed"] += 1
+            raise error
+        client.stats["retries"] += 1
+    delay = min(MAX_BACKOFF, client.backoff * 2 ** attempt)
+    logger.warning(f"Request to AnkiConnect failed ({error.reason}), retrying in {delay:.1f} seconds")
+    return delay
+
+
+class AnkiConnectClient:
+    """Client for the AnkiConnect API which reuses one keep-alive connection
+
+    AnkiConnect may close the connection after any response, in which case the 
+    next request opens a new one. Requests which can't reach AnkiConnect or time 
+    out are retried up to `retries` times with exponential backoff, and 
+    `breaker` pauses requests while AnkiConnect is down. Requests with actions 
+    which change Anki, like `addNotes`, may have been carried out before the 
+    connection failed, so they're only retried when AnkiConnect refused the 
+    connection. Errors returned by AnkiConnect for an action aren't retried.
+
+    `stats` counts the requests sent, retried and failed.
+    """
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT, 
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, breaker=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.stats = Counter()
+        self._conn = None
+        # http.client connections can only handle one request at a time. Also 
+        # guards the stats and breaker, which requests update from several threads.
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def invoke(self, action, **params):
+        return _parse_response(self.request(_create_request_dict(action, **params)))
+
+    def request(self, request_dict, retry=True):
+        "Send a request to AnkiConnect and return the decoded response"
+        body = json.dumps(request_dict).encode('utf-8')
+        read_only = _is_read_only(request_dict)
+        for attempt in range(self.retries + 1 if retry else 1):
+            time.sleep(_pause_for_breaker(self))
+            try:
+                response = self._request_once(body)
+            except urllib.error.URLError as e:
+                delay = _record_failure(self, attempt, retry and (read_only or _connection_refused(e)), e)
+                time.sleep(delay)
+                continue
+            _record_success(self)
+            return response
+
+    def _request_once(self, body):
+        with self._lock:
+            self.stats["requests"] += 1
+            reused = self._conn is not None
+            try:
+                return self._send(body)
+            except (http.client.HTTPException, ConnectionError) as e:
+                self.close()
+                if not reused:
+                    raise urllib.error.URLError(e)
+                # AnkiConnect closed the idle connection before this request was 
+                # read, so retry once on a new connection
+                try:
+                    return self._send(body)
+                except (http.client.HTTPException, OSError) as e:
+                    self.close()
+                    raise urllib.error.URLError(e)
+            except OSError as e:
+                self.close()
+                raise urllib.error.URLError(e)
+
+    def _send(self, body):
+        if self._conn is None:
+            self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self._conn.connect()
+            # Don't hold back small requests waiting for the previous one to be acked
+            self._conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._conn.request("POST", "/", body, {"Content-Type": "application/json"})
+        response = self._conn.getresponse()
+        data = response.read()
+        if response.will_close:
+            self.close()
+        if response.status != 200:
+            raise http.client.HTTPException(f"AnkiConnect responded with {response.status} {response.reason}")
+        return json.loads(data)
+
+    def connection_open(self):
+        try:
+            self.request({}, retry=False)
+        except urllib.error.URLError:
+            return False
+        return True
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class AsyncAnkiConnectClient:
+    """Asyncio client for the AnkiConnect API with a limit on requests in flight
+
+    Has async versions of the module's functions, like `add_note` and 
+    `get_note`. Up to `max_in_flight` requests are sent at once, each on its 
+    own keep-alive connection, and further requests wait for one to finish.
+    Failed requests are retried like with AnkiConnectClient. A client should 
+    only be used from one event loop.
+    """
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT, 
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, 
+                 breaker=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.stats = Counter()
+        # Guards the stats and breaker, which may be shared with a client in 
+        # another thread. Never held across an await.
+        self._lock = threading.Lock()
+        self._idle = []
+        self._semaphore = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def invoke(self, action, **params):
+        return _parse_response(await self.request(_create_request_dict(action, **params)))
+
+    async def request(self, request_dict, retry=True):
+        "Send a request to AnkiConnect and return the decoded response"
+        body = json.dumps(request_dict).encode('utf-8')
+        read_only = _is_read_only(request_dict)
+        for attempt in range(self.retries + 1 if retry else 1):
+            await asyncio.sleep(_pause_for_breaker(self))
+            try:
+                response = await self._request_once(body)
+            except urllib.error.URLError as e:
+                delay = _record_failure(self, attempt, retry and (read_only or _connection_refused(e)), e)
+                await asyncio.sleep(delay)
+                continue
+            _record_success(self)
+            return response
+
+    async def _request_once(self, body):
+        with self._lock:
+            self.stats["requests"] += 1
+        if self._semaphore is None:
+            # Created here so it belongs to the running event loop
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self._semaphore:
+            conn = self._idle.pop() if self._idle else None
+            try:
+                return await self._send(conn or await self._connect(), body)
+            except (http.client.HTTPException, ConnectionError, asyncio.IncompleteReadError) as e:
+                if conn is None:
+                    raise urllib.error.URLError(e)
+                # AnkiConnect closed the idle connection, so retry once on a new one
+                try:
+                    return await self._send(await self._connect(), body)
+                except (http.client.HTTPException, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                    raise urllib.error.URLError(e)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise urllib.error.URLError(e)
+
+    async def _connect(self):
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise urllib.error.URLError(e)
+
+    async def _send(self, conn, body):
+        reader, writer = conn
+        try:
+            response, keep_alive = await asyncio.wait_for(self._exchange(reader, writer, body), self.timeout)
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive:
+            self._idle.append(conn)
+        else:
+            writer.close()
+        return response
+
+    async def _exchange(self, reader, writer, body):
+        head = (f"POST / HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+        status_line = (await reader.readline()).decode('latin-1')
+        if not status_line:
+            raise http.client.RemoteDisconnected("Remote end closed connection without response")
+        version, status, *_ = status_line.split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if status != "200":
+            raise http.client.HTTPException(f"AnkiConnect responded with {status_line.strip()}")
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        if "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await reader.read()
+            keep_alive = False
+        return json.loads(data), keep_alive
+
+    async def connection_open(self):
+        try:
+            await self.request({}, retry=False)
+        except urllib.error.URLError:
+            return False
+        return True
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+    async def send_batch(self, batch):
+        "Async version of `ActionBatch.send`, which sends the batch's requests concurrently"
+        pending, chunks = batch._take_chunks()
+        async def send_chunk(chunk, actions):
+            try:
+                responses = await self.invoke("multi", actions=actions)
+            except Exception as e:
+                responses = e
+            ActionBatch._set_results(chunk, responses)
+        await asyncio.gather(*(send_chunk(chunk, actions) for chunk, actions in chunks))
+        return pending
+
+    async def run_steps(self, steps):
+        "Async version of `run_steps`"
+        while True:
+            try:
+                batch = next(steps)
+            except StopIteration as e:
+                return e.value
+            await self.send_batch(batch)
+
+    async def add_note(self, anki_dict):
+        for image in anki_dict.pop("images", []):
+            await self.add_media(image)
+        return await self.invoke("addNote", note=anki_dict)
+
+    async def add_notes(self, anki_dicts, batch_size=DEFAULT_BATCH_SIZE, max_bytes=DEFAULT_MAX_REQUEST_BYTES):
+        return await self.run_steps(add_notes_steps(anki_dicts, batch_size, max_bytes))
+
+    async def update_note(self, anki_dict, note_id=None):
+        for image in anki_dict.pop("images", []):
+            await self.add_media(image)
+        note_id = note_id or await self.get_note_id(anki_dict)
+        return await self.update_fields(note_id, anki_dict["fields"])
+
+    async def update_fields(self, note_id, fields):
+        return await self.invoke("updateNoteFields", note={"id": note_id, "fields": fields})
+
+    async def update_notes_fields(self, updates, max_bytes=DEFAULT_MAX_REQUEST_BYTES):
+        return await self.run_steps(update_notes_fields_steps(updates, max_bytes))
+
+    async def add_media(self, media):
+        return await self.invoke("storeMediaFile", **media)
+
+    async def get_note_id(self, anki_dict):
+        res = await self.invoke('findNotes', query=f"uid:{anki_dict['fields']['uid']}")
+        return res[0] if res else None
+
+    async def get_note(self, note_id):
+        res = await self.invoke("notesInfo", notes=[note_id])
+        return res[0] if res else None
+
+    async def get_card_ids(self, anki_dict):
+        return await self.invoke('findCards', query=f"uid:{anki_dict['fields']['uid']}")
+
+    async def get_field_names(self, note_type):
+        return await self.invoke('modelFieldNames', modelName=note_type)
+
+
+_client = AnkiConnectClient()
+
+def configure(host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    "Set the AnkiConnect address and retry settings used by the functions in this module"
+    global _client
+    _client.close()
+    _client = AnkiConnectClient(host, port, timeout, retries, backoff)
+    return _client
+
+def get_client():
+    return _client
+
 def connection_open():
-    request = urllib.request.Request('http://localhost:8765', json.dumps({}).encode("utf-8"))
-    try:
-        response = json.load(urllib.request.urlopen(request))
-    except urllib.request.URLError:
-        return False
-    return True
+    return _client.connection_open()
 
 def _create_request_dict(action, **params):
-    return {'action': action, 'params': params, 'version': 6}
+    return {'action': action, 'params': params, 'version': API_VERSION}
 
-def _invoke(action, **params):
-    requestDict = _create_request_dict(action, **params)
-    requestJson = json.dumps(requestDict).encode('utf-8')
-    request = urllib.request.Request('http://localhost:8765', requestJson)
-    response = json.load(urllib.request.urlopen(request))
+def _parse_response(response):
     if len(response) != 2:
         raise BadResponse(response, 'response has an unexpected number of fields')
     if 'error' not in response:
@@ -37,9 +458,235 @@ def _invoke(action, **params):
             raise GenericResponseError(response['error'])
     return response['result']
 
-def upload_all(anki_dicts):
-    for anki_dict in anki_dicts:
-        upload(anki_dict)
+def _invoke(action, **params):
+    return _client.invoke(action, **params)
+
+
+class PendingAction:
+    "An action queued in an ActionBatch, which holds the result once the batch is sent"
+    def __init__(self, action, params):
+        self.action = action
+        self.params = params
+        self.done = False
+        self.error = None
+        self._result = None
+
+    def set_result(self, result):
+        self._result = result
+        self.done = True
+
+    def set_error(self, error):
+        self.error = error
+        self.done = True
+
+    def result(self):
+        "Return the result of the action or raise the error AnkiConnect returned for it"
+        if not self.done:
+            raise ValueError(f"'{self.action}' action hasn't been sent yet")
+        if self.error is not None:
+            raise self.error
+        return self._result
+
+    def __repr__(self):
+        return "<%s(action='%s', done=%s)>" % (self.__class__.__name__, self.action, self.done)
+
+
+class ActionBatch:
+    """Queue up actions and send them to AnkiConnect in `multi` requests
+
+    Errors are kept on each action rather than raised, so one failing action 
+    doesn't affect the rest of the batch. If a request fails, every action 
+    in that request gets the error.
+
+    Args:
+        client (AnkiConnectClient): Client to send with. Defaults to the client 
+            set with `configure`.
+        max_bytes (int): Actions are split over several requests so that each 
+            request body stays under this size, unless a single action is larger.
+    """
+    def __init__(self, client=None, max_bytes=DEFAULT_MAX_REQUEST_BYTES):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.pending = []
+
+    def add(self, action, **params):
+        pending_action = PendingAction(action, params)
+        self.pending.append(pending_action)
+        return pending_action
+
+    def send(self, client=None):
+        "Send the queued actions and return them with their results filled in"
+        client = client or self.client or _client
+        pending, chunks = self._take_chunks()
+        for chunk, actions in chunks:
+            try:
+                responses = client.invoke("multi", actions=actions)
+            except Exception as e:
+                responses = e
+            self._set_results(chunk, responses)
+        return pending
+
+    def _take_chunks(self):
+        "Empty the queue and split the actions into the lists to send in each request"
+        pending, self.pending = self.pending, []
+        actions = [_create_request_dict(p.action, **p.params) for p in pending]
+        chunks = [([p for p, _ in chunk], [a for _, a in chunk]) 
+                  for chunk in _chunk_by_size(list(zip(pending, actions)), self.max_bytes, key=lambda x: x[1])]
+        return pending, chunks
+
+    @staticmethod
+    def _set_results(pending, responses):
+        "Fill in the actions from the responses to their request, or the exception it raised"
+        if not isinstance(responses, Exception) and len(responses) != len(pending):
+            responses = BadResponse(responses, 'multi response has an unexpected number of results')
+        if isinstance(responses, Exception):
+            for pending_action in pending:
+                pending_action.set_error(responses)
+            return
+        for pending_action, response in zip(pending, responses):
+            try:
+                pending_action.set_result(_parse_response(response))
+            except AnkiConnectException as e:
+                pending_action.set_error(e)
+
+    def __len__(self):
+        return len(self.pending)
+
+def run_steps(steps, client=None):
+    """Send each ActionBatch yielded by a generator and return what the generator returns
+
+    Functions ending in `_steps` are written as generators like this, so the 
+    same logic can be sent with AnkiConnectClient or AsyncAnkiConnectClient.
+    """
+    while True:
+        try:
+            batch = next(steps)
+        except StopIteration as e:
+            return e.value
+        batch.send(client)
+
+def _chunk_by_size(items, max_bytes, max_items=None, key=lambda x: x):
+    """Split items into lists whose JSON encoding stays under `max_bytes`
+
+    An item larger than `max_bytes` on its own gets a list to itself.
+    """
+    chunk, chunk_bytes = [], 0
+    for item in items:
+        # Each item is followed by a comma and space in the encoded list
+        item_bytes = len(json.dumps(key(item)).encode('utf-8')) + 2
+        if chunk and (chunk_bytes + item_bytes > max_bytes or len(chunk) == max_items):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(item)
+        chunk_bytes += item_bytes
+    if chunk:
+        yield chunk
+
+def add_notes(anki_dicts, client=None, batch_size=DEFAULT_BATCH_SIZE, max_bytes=DEFAULT_MAX_REQUEST_BYTES):
+    """Add notes with `addNotes`, sending up to `batch_size` notes per action
+
+    Notes should already have their images stored. Requests are also split to 
+    keep each body under `max_bytes`. 
+
+    Returns:
+        list of PendingAction: One "addNote" action per note, holding the new 
+            note's id or the error adding it.
+    """
+    return run_steps(add_notes_steps(anki_dicts, batch_size, max_bytes), client)
+
+def add_notes_steps(anki_dicts, batch_size=DEFAULT_BATCH_SIZE, max_bytes=DEFAULT_MAX_REQUEST_BYTES):
+    "`add_notes` as a generator for `run_steps`"
+    pending = [PendingAction("addNote", {"note": anki_dict}) for anki_dict in anki_dicts]
+    batch = ActionBatch(max_bytes=max_bytes)
+    chunks = [(chunk, batch.add("addNotes", notes=[p.params["note"] for p in chunk]))
+              for chunk in _chunk_by_size(pending, max_bytes, batch_size, key=lambda p: p.params["note"])]
+    yield batch
+    failed = []
+    for chunk, action in chunks:
+        note_ids = action.result() if action.error is None else None
+        if not isinstance(note_ids, list) or len(note_ids) != len(chunk):
+            # Newer versions of AnkiConnect fail the whole action when any note 
+            # can't be added, so add the notes one by one to find which ones failed
+            logger.debug("addNotes failed, adding %d notes one at a time: %s", len(chunk), action.error)
+            failed.extend(chunk)
+            continue
+        for pending_action, note_id in zip(chunk, note_ids):
+            if note_id is None:
+                # Older versions of AnkiConnect return null for notes which failed
+                pending_action.set_error(GenericResponseError("note could not be added"))
+            else:
+                pending_action.set_result(note_id)
+    if failed:
+        yield from _add_notes_one_by_one_steps(failed, max_bytes)
+    return pending
+
+def _add_notes_one_by_one_steps(pending, max_bytes):
+    # Some of the notes may have been added before the action failed
+    batch = ActionBatch(max_bytes=max_bytes)
+    found = [batch.add("findNotes", query=f"uid:{p.params['note']['fields']['uid']}") 
+             if "uid" in p.params["note"].get("fields", {}) else None 
+             for p in pending]
+    yield batch
+    to_add = []
+    for pending_action, find_action in zip(pending, found):
+        note_ids = find_action.result() if find_action and find_action.error is None else None
+        if note_ids:
+            pending_action.set_result(note_ids[0])
+        else:
+            to_add.append((pending_action, batch.add("addNote", **pending_action.params)))
+    yield batch
+    for pending_action, add_action in to_add:
+        if add_action.error is not None:
+            pending_action.set_error(add_action.error)
+        else:
+            pending_action.set_result(add_action.result())
+
+def update_notes_fields(updates, client=None, max_bytes=DEFAULT_MAX_REQUEST_BYTES):
+    """Update the fields of many notes with batched `updateNoteFields` actions
+
+    Args:
+        updates (list of tuple): Note ids and the fields to set on each note
+
+    Returns:
+        list of PendingAction: One "updateNoteFields" action per note
+    """
+    return run_steps(update_notes_fields_steps(updates, max_bytes), client)
+
+def update_notes_fields_steps(updates, max_bytes=DEFAULT_MAX_REQUEST_BYTES):
+    "`update_notes_fields` as a generator for `run_steps`"
+    batch = ActionBatch(max_bytes=max_bytes)
+    pending = [batch.add("updateNoteFields", note={"id": note_id, "fields": fields}) 
+               for note_id, fields in updates]
+    yield batch
+    return pending
+
+def upload_all(anki_dicts, batch_size=DEFAULT_BATCH_SIZE, max_bytes=DEFAULT_MAX_REQUEST_BYTES):
+    """Add or update notes in bulk
+
+    Returns:
+        list of PendingAction: One action per note, holding the id of the added 
+            note or the result of the update, or the error uploading the note.
+    """
+    anki_dicts = list(anki_dicts)
+    batch = ActionBatch(max_bytes=max_bytes)
+    find_actions = [batch.add("findNotes", query=f"uid:{d['fields']['uid']}") for d in anki_dicts]
+    image_actions = [[batch.add("storeMediaFile", **image) for image in d.pop("images", [])] for d in anki_dicts]
+    batch.send()
+    results = [None] * len(anki_dicts)
+    to_add, to_update = [], []
+    for i, (anki_dict, find_action) in enumerate(zip(anki_dicts, find_actions)):
+        failed = [a for a in [find_action] + image_actions[i] if a.error is not None]
+        if failed:
+            results[i] = failed[0]
+        elif find_action.result():
+            to_update.append((i, (find_action.result()[0], anki_dict["fields"])))
+        else:
+            to_add.append((i, anki_dict))
+    added = add_notes([d for _, d in to_add], batch_size=batch_size, max_bytes=max_bytes)
+    updated = update_notes_fields([u for _, u in to_update], max_bytes=max_bytes)
+    for (i, _), action in zip(to_add + to_update, added + updated):
+        results[i] = action
+    return results
 
 def upload(anki_dict):
     note_id = get_note_id(anki_dict)
@@ -67,6 +714,37 @@ def unsuspend_note(anki_dict):
     card_ids = get_card_ids(anki_dict)
     return _invoke("unsuspend", cards=card_ids)
 
+def update_suspended(to_suspend, to_unsuspend, client=None):
+    """Suspend and unsuspend cards, skipping cards which are already in that state
+
+    Checks every card with one `areSuspended` request, then sends at most one 
+    `suspend` and one `unsuspend` action together.
+
+    Returns:
+        tuple: The ids of the cards which were suspended and unsuspended
+    """
+    client = client or _client
+    cards = list(to_suspend) + list(to_unsuspend)
+    if not cards:
+        return [], []
+    try:
+        states = dict(zip(cards, client.invoke("areSuspended", cards=cards)))
+    except GenericResponseError:
+        # areSuspended isn't supported by older versions of AnkiConnect
+        logger.debug("Couldn't get the suspended state of cards", exc_info=True)
+        suspend, unsuspend = list(to_suspend), list(to_unsuspend)
+    else:
+        # areSuspended returns null for cards which don't exist
+        suspend = [c for c in to_suspend if states[c] is False]
+        unsuspend = [c for c in to_unsuspend if states[c] is True]
+    batch = ActionBatch(client)
+    for action, card_ids in [("suspend", suspend), ("unsuspend", unsuspend)]:
+        if card_ids:
+            batch.add(action, cards=card_ids)
+    for action in batch.send():
+        action.result()
+    return suspend, unsuspend
+
 def update_fields(note_id, fields):
     note = {"id":note_id, "fields": fields}
     return _invoke("updateNoteFields", note=note)
@@ -82,10 +760,103 @@ def found_media(filename):
         logging.warning(f"Exception while looking for media: {e}")
         return False
 
+def get_media_file_names(pattern="*"):
+    return _invoke("getMediaFilesNames", pattern=pattern)
+
+
+class MediaManifest:
+    """Media files in Anki, listed with one `getMediaFilesNames` request
+
+    Checking whether a file is in Anki doesn't transfer the file, unlike 
+    `found_media`. The manifest also maps the hash of each file added to it to 
+    its filename, so a file with the same content as one already stored can 
+    reuse it instead of being uploaded again.
+    """
+    def __init__(self, client=None):
+        self.client = client
+        self.filenames = None
+        self.hashes = {}
+        self._loaded = False
+
+    def load(self):
+        """List the media files in Anki
+
+        If they can't be listed, the manifest is still marked as loaded so it 
+        doesn't ask again, and checks for each file with `found_media` instead.
+        """
+        try:
+            self.filenames = set((self.client or _client).invoke("getMediaFilesNames", pattern="*"))
+            logger.debug(f"Found {len(self.filenames)} media files in Anki")
+        except GenericResponseError:
+            # getMediaFilesNames isn't supported by older versions of AnkiConnect
+            logger.debug("Couldn't list media files, checking for each file instead", exc_info=True)
+            self.filenames = None
+        except (AnkiConnectException, urllib.error.URLError) as e:
+            logger.warning(f"Couldn't list media files, checking for each file instead: {e}")
+            self.filenames = None
+        self._loaded = True
+
+    def __contains__(self, filename):
+        if not self._loaded:
+            self.load()
+        if self.filenames is None:
+            return filename in self.hashes.values() or found_media(filename)
+        return filename in self.filenames
+
+    def find(self, content):
+        "Return the filename of a file added with the same content, or None"
+        return self.hashes.get(hashlib.sha256(content).hexdigest())
+
+    def add(self, filename, content):
+        "Record a file which is being stored in Anki"
+        self.hashes.setdefault(hashlib.sha256(content).hexdigest(), filename)
+        if self.filenames is not None:
+            self.filenames.add(filename)
+
 def update_tags(note_id, tags):
-    old_tags = get_note_tags(note_id)
-    delete_tags(note_id, old_tags)
-    add_tags(note_id, tags)
+    for action in sync_tags({note_id: tags}):
+        action.result()
+
+def sync_tags(note_tags, current_tags=None, client=None):
+    """Set the tags of many notes, only adding and removing the tags which differ
+
+    Notes which need the same tags added or removed share one `addTags` or 
+    `removeTags` action, and all the actions are sent in one batch.
+
+    Args:
+        note_tags (dict): Maps note ids to the tags each note should have
+        current_tags (dict): Maps note ids to the tags each note has now. Notes 
+            which aren't in it are looked up with one `notesInfo` request, and 
+            skipped if they aren't in Anki.
+
+    Returns:
+        list of PendingAction: The `addTags` and `removeTags` actions sent
+    """
+    current_tags = dict(current_tags or {})
+    missing = [note_id for note_id in note_tags if note_id not in current_tags]
+    if missing:
+        for note in (client or _client).invoke("notesInfo", notes=missing):
+            # notesInfo returns an empty dict for notes which don't exist
+            if not note:
+                continue
+            current_tags[note["noteId"]] = note.get("tags", [])
+    to_remove, to_add = {}, {}
+    for note_id, tags in note_tags.items():
+        if note_id not in current_tags:
+            logger.debug(f"Skipping tags of note {note_id}, which isn't in Anki")
+            continue
+        tags, old_tags = set(tags), set(current_tags[note_id])
+        if old_tags - tags:
+            to_remove.setdefault(frozenset(old_tags - tags), []).append(note_id)
+        if tags - old_tags:
+            to_add.setdefault(frozenset(tags - old_tags), []).append(note_id)
+    batch = ActionBatch(client)
+    # Remove first since Anki matches tags case-insensitively, so removing "Tag" 
+    # after adding "tag" would remove the new tag
+    for action, groups in [("removeTags", to_remove), ("addTags", to_add)]:
+        for tags, note_ids in groups.items():
+            batch.add(action, notes=note_ids, tags=" ".join(sorted(tags)))
+    return batch.send()
 
 def delete_tags(note_id, tags):
     for tag in tags:
@@ -104,6 +875,37 @@ def get_note_id(anki_dict):
         return res[0]
     return None
 
+def find_note_ids(note_types):
+    "Get the ids of every note of the given note types, without their fields"
+    query = " or ".join('"note:%s"' % note_type.replace('"', '\\"') for note_type in note_types)
+    return _invoke("findNotes", query=query)
+
+def get_notes_by_uid(note_types):
+    """Get every note of the given note types with one findNotes and one notesInfo
+
+    Returns:
+        dict: Maps the uid field of each note to a dict with the note's "noteId", 
+            "modelName", "fields" (field names to values), "tags" and "cards". 
+            "cards" is None when AnkiConnect doesn't include them.
+    """
+    note_ids = find_note_ids(note_types)
+    if not note_ids:
+        return {}
+    notes = {}
+    # Keep the oldest note when uids are duplicated
+    for note in sorted(_invoke("notesInfo", notes=note_ids), key=lambda n: n.get("noteId", 0)):
+        fields = {k: v['value'] for k,v in note.get('fields', {}).items()}
+        if "uid" not in fields:
+            continue
+        notes.setdefault(fields["uid"], {
+            "noteId": note["noteId"],
+            "modelName": note.get("modelName"),
+            "fields": fields,
+            "tags": note.get("tags", []),
+            "cards": note.get("cards"),
+        })
+    return notes
+
 def get_card_ids(anki_dict):
     res = _invoke('findCards', query=f"uid:{anki_dict['fields']['uid']}")
     return res
@@ -191,3 +993,7 @@ class ModelNotFoundError(AnkiConnectException):
 class DuplicateError(AnkiConnectException):
     def __init__(self, response_error):
         self.response_error = response_error
+
+class CircuitOpenError(urllib.error.URLError):
+    "Raised instead of sending a request while AnkiConnect is failing every request"
+    pass
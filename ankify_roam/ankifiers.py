@@ -5,7 +5,13 @@ import logging
 import re
 import inspect
 import string
+import asyncio
+import contextlib
+import math
+import traceback
+import multiprocessing
 from itertools import zip_longest
+from collections import Counter
 import base64
 from bs4 import BeautifulSoup
 import requests
@@ -13,15 +19,21 @@ from urllib.parse import urlparse
 from ankify_roam import roam
 from ankify_roam import anki
 from ankify_roam.default_models import ROAM_BASIC, ROAM_CLOZE
+from ankify_roam.pipeline import Pipeline
+from ankify_roam.sync_state import SyncState, block_hash, note_hash
+from ankify_roam._version import __version__
 
 logger = logging.getLogger(__name__)
 
 ASCII_NON_PRINTABLE = "".join([chr(i) for i in range(128) 
                                if chr(i) not in string.printable])
 
+# Batches each queue between the stages of `RoamGraphAnkifier.ankify` holds
+PIPELINE_QUEUE_SIZE = 2
+
 
 class RoamGraphAnkifier:
-    def __init__(self, deck="Default", note_basic="Roam Basic", note_cloze="Roam Cloze", pageref_cloze="outside", tag_ankify="ankify", tag_dont_ankify="dont-ankify", tag_ankify_root="ankify-root", num_parents=0, include_page=False, max_depth=None, tags_from_attr=False, download_imgs='never'):
+    def __init__(self, deck="Default", note_basic="Roam Basic", note_cloze="Roam Cloze", pageref_cloze="outside", tag_ankify="ankify", tag_dont_ankify="dont-ankify", tag_ankify_root="ankify-root", num_parents=0, include_page=False, max_depth=None, tags_from_attr=False, download_imgs='never', batch_size=anki.DEFAULT_BATCH_SIZE, max_in_flight=None, jobs=1, sync_state=None, full=False):
         self.deck = deck
         self.note_basic = note_basic
         self.note_cloze = note_cloze
@@ -34,6 +46,15 @@ class RoamGraphAnkifier:
         self.max_depth = max_depth
         self.tags_from_attr = tags_from_attr
         self.download_imgs = download_imgs
+        self.batch_size = batch_size
+        # Upload with AsyncAnkiConnectClient, sending up to this many batches at once
+        self.max_in_flight = max_in_flight
+        # Number of processes to convert blocks to notes with
+        self.jobs = jobs
+        # Path of the file remembering which blocks were synced in earlier runs. 
+        # Blocks which haven't changed since are skipped, unless `full` is set.
+        self.sync_state = sync_state
+        self.full = full
         
     def check_conn_and_params(self):
         if not anki.connection_open():
@@ -68,49 +89,541 @@ class RoamGraphAnkifier:
             return False
 
     def ankify(self, roam_graph):
+        """Add or update the notes for every block with the ankify tag
+
+        Runs as a pipeline of stages in their own threads, so blocks are 
+        converted while earlier batches are being sent to AnkiConnect:
+
+            select: Split the blocks to ankify into batches
+            convert: Convert blocks to anki notes
+            diff: Look up the notes in Anki and see which are new or changed
+            upload: Add and update notes and collect the cards to suspend
+
+        The blocks to ankify are found before the pipeline starts. With 
+        `sync_state`, blocks are skipped then when neither they, their parents 
+        nor the blocks they reference changed since the last sync, and their 
+        notes are still in Anki. The notes of other synced blocks are compared 
+        by `note_hash` instead of downloading their fields, unless `full` is set. 
+        With `jobs`, blocks are converted by worker processes which start 
+        before the pipeline, and the convert stage takes their notes in order.
+        """
         self.check_conn_and_params()
-        blocks_to_ankify = roam_graph.query_many(
-            lambda b: self.is_block_to_ankify(b))
-
-        logger.info(f"Found {len(blocks_to_ankify)} blocks with ankify tag")
 
         block_ankifier_args = inspect.getfullargspec(BlockAnkifier.__init__).args
         kwargs = {k:v for k,v in vars(self).items() if k in block_ankifier_args}
         block_ankifier = BlockAnkifier(**kwargs)
+        for note_type in [self.note_basic, self.note_cloze]:
+            if note_type not in block_ankifier.field_names:
+                block_ankifier.field_names[note_type] = anki.get_field_names(note_type)
+
+        if self.sync_state:
+            settings = dict(kwargs, tag_dont_ankify=self.tag_dont_ankify, 
+                            field_names=block_ankifier.field_names, version=__version__)
+            sync_state = SyncState(self.sync_state, settings).load()
+        else:
+            sync_state = None
 
-        num_added = 0
-        num_updated = 0
-        num_no_change = 0
-        num_failed = 0
-        for block in blocks_to_ankify:
+        if sync_state and not self.full:
+            note_ids = anki.find_note_ids([self.note_basic, self.note_cloze])
+            existing_notes = sync_state.get_notes(note_ids)
+            logger.info(f"Found {len(note_ids)} notes in Anki, {len(existing_notes)} of them synced before")
+        else:
+            existing_notes = anki.get_notes_by_uid([self.note_basic, self.note_cloze])
+            logger.info(f"Found {len(existing_notes)} notes in Anki")
+
+        # Content hash and latest edit time of each selected block, by uid
+        block_hashes = {}
+        # Note id and `note_hash` of the blocks whose notes are in sync with Anki, by uid
+        synced = {}
+
+        tag_cache_start = roam.Block.tag_cache_info()
+        # Each stage counts into its own Counter since they run in different threads
+        stage_counts = {"select": Counter(), "convert": Counter(), "diff": Counter(), "upload": Counter()}
+        # Card ids to suspend (True) and unsuspend (False), sent once at the end
+        suspend_cards = {True: [], False: []}
+        request_stats = Counter()
+        request_stats_start = Counter(anki.get_client().stats)
+
+        # Blocks are found before the pipeline starts, since the worker processes 
+        # for `jobs` have to be forked before there are other threads
+        blocks = roam_graph.query_by_tag(
+            self.tag_ankify, inherit=False, from_attr=self.tags_from_attr, 
+            exclude=self.tag_dont_ankify)
+        logger.info(f"Found {len(blocks)} blocks with ankify tag")
+        if sync_state:
+            blocks = self._skip_synced_blocks(blocks, sync_state, existing_notes, block_hashes)
+            stage_counts["select"]["no_change"] = len(block_hashes) - len(blocks)
+
+        def select():
+            for start in range(0, len(blocks), self.batch_size):
+                yield blocks[start:start + self.batch_size]
+
+        def convert(block_batches):
+            blocks = (block for blocks in block_batches for block in blocks)
+            return self._iter_note_batches(blocks, block_ankifier, stage_counts["convert"], converted)
+
+        def diff(note_batches):
+            for notes in note_batches:
+                yield notes, anki.run_steps(self._diff_steps(notes, stage_counts["diff"], existing_notes))
+
+        def upload(diffs):
+            if self.max_in_flight:
+                request_stats.update(asyncio.run(self._upload_async(diffs, stage_counts["upload"], suspend_cards, synced)))
+            else:
+                for notes, notes_diff in diffs:
+                    anki.run_steps(self._upload_steps(notes, notes_diff, stage_counts["upload"], suspend_cards, synced))
+
+        with self._conversion_pool(blocks, block_ankifier) as converted:
+            pipeline = Pipeline(maxsize=PIPELINE_QUEUE_SIZE)
+            pipeline.add_stage("select", select, size=len)
+            pipeline.add_stage("convert", convert, size=len)
+            pipeline.add_stage("diff", diff, size=len)
+            pipeline.add_stage("upload", upload, size=lambda item: len(item[0]))
+            stage_stats = pipeline.run()
+
+        self._update_suspended(suspend_cards)
+        if sync_state:
+            for uid, (note_id, synced_hash) in synced.items():
+                sync_state.record(uid, *block_hashes[uid], note_id, synced_hash)
+            self._save_sync_state(sync_state)
+        counts = sum(stage_counts.values(), Counter())
+        request_stats.update(anki.get_client().stats - request_stats_start)
+        logger.info(f"Results: {counts['added']} notes added, {counts['updated']} updated, {counts['no_change']} unchanged, {counts['failed']} failed")
+        self._log_request_stats(request_stats)
+        self._log_tag_cache_stats(tag_cache_start, stage_stats[0].items)
+        logger.info("Pipeline: " + " -> ".join(str(stats) for stats in stage_stats))
+
+    def _skip_synced_blocks(self, blocks, sync_state, existing_notes, block_hashes):
+        "Return the blocks which changed since the last sync, adding every block's hash to `block_hashes`"
+        to_sync = []
+        for block in blocks:
+            block_hashes[block.uid] = block_hash(block, from_attr=self.tags_from_attr)
+            note_id = existing_notes.get(block.uid, {}).get("noteId")
+            if self.full or not sync_state.is_synced(block.uid, block_hashes[block.uid][0], note_id):
+                to_sync.append(block)
+        if len(to_sync) < len(blocks):
+            logger.info(f"Skipping {len(blocks) - len(to_sync)} blocks which haven't changed since the last sync")
+        return to_sync
+
+    @staticmethod
+    def _save_sync_state(sync_state):
+        try:
+            sync_state.save()
+        except OSError:
+            logger.exception(f"Failed saving sync state to '{sync_state.path}'")
+
+    def _iter_note_batches(self, blocks, block_ankifier, counts, converted=None):
+        "Convert blocks to anki notes, yielding lists of up to `batch_size` blocks and their notes"
+        notes = []
+        for block, note in self._convert_blocks(blocks, block_ankifier, counts, converted):
+            notes.append((block, note))
+            if len(notes) == self.batch_size:
+                yield notes
+                notes = []
+        if notes:
+            yield notes
+
+    def _convert_blocks(self, blocks, block_ankifier, counts, converted=None):
+        """Convert blocks to anki notes, yielding each block and its note in block order
+
+        Args:
+            converted (iterator): What `_conversion_pool` returned for the blocks, 
+                to take their notes from the worker processes instead
+        """
+        if converted is not None:
+            blocks = iter(blocks)
+            for results in converted:
+                # Take a result before a block, so no block is lost at the end of a chunk
+                for (note, error), block in zip(results, blocks):
+                    if error:
+                        logger.error(f"Failed ankifying {block} during conversion to anki note\n{error}")
+                        counts["failed"] += 1
+                    else:
+                        yield block, note
+            return
+        for block in blocks:
             try:
-                ankified_note = block_ankifier.ankify(block)
+                yield block, block_ankifier.ankify(block)
             except:
                 logger.exception(f"Failed ankifying {block} during conversion to anki note")
-                num_failed += 1
-                continue
+                counts["failed"] += 1
+
+    @contextlib.contextmanager
+    def _conversion_pool(self, blocks, block_ankifier):
+        """Convert blocks to anki notes across `jobs` processes
+
+        Workers are forked so they share the graph with this process, and are 
+        only sent the positions of the blocks to convert. Forking while other 
+        threads hold locks can deadlock the workers, so enter this before 
+        starting any threads. Yields an iterator over the results of each chunk 
+        of blocks, in block order, which fills in while the remaining blocks 
+        are converted. Yields None when the blocks should be converted in this 
+        process instead.
+        """
+        if self.jobs <= 1 or len(blocks) <= 1:
+            yield None
+            return
+        if "fork" not in multiprocessing.get_all_start_methods():
+            logger.warning("Converting blocks in one process since processes can't be forked on this platform")
+            yield None
+            return
+        # Several chunks per worker keeps them busy until the end
+        chunk_size = max(1, min(self.batch_size, math.ceil(len(blocks) / (self.jobs * 4))))
+        spans = [(start, min(start + chunk_size, len(blocks))) for start in range(0, len(blocks), chunk_size)]
+        # List the media in Anki once here, rather than once in each worker. 
+        # Blocks can only download images if they or their parents set the option.
+        if block_ankifier.download_imgs != 'never' or any(
+                "download-imgs" in b.string for block in blocks for b in [block] + block.parent_blocks):
+            block_ankifier.media_manifest.load()
+        # Don't share this process's connection to AnkiConnect with the workers
+        client = anki.get_client()
+        client.close()
+        context = multiprocessing.get_context("fork")
+        with context.Pool(min(self.jobs, len(spans)), _init_conversion_worker, (blocks, block_ankifier, client)) as pool:
+            yield pool.imap(_convert_blocks_in_worker, spans)
+
+    async def _upload_async(self, diffs, *args):
+        """Upload batches of notes concurrently with AsyncAnkiConnectClient
+
+        Takes each batch from the diff stage once it's ready. Once 
+        `max_in_flight` batches are uploading, waits for one to finish before 
+        taking the next. Returns the async client's request stats.
+        """
+        sync_client = anki.get_client()
+        # Share the circuit breaker so both clients pause when AnkiConnect is down
+        client = anki.AsyncAnkiConnectClient(
+            sync_client.host, sync_client.port, sync_client.timeout, max_in_flight=self.max_in_flight, 
+            retries=sync_client.retries, backoff=sync_client.backoff, breaker=sync_client.breaker)
+        uploads_in_flight = asyncio.Semaphore(self.max_in_flight)
+        async def upload(notes, notes_diff):
             try:
-                # Add or update the anki note
-                note_id = anki.get_note_id(ankified_note)
-                if note_id:
-                    existing_fields = {k: v['value'] for k,v in anki.get_note(note_id)['fields'].items()}
-                    if existing_fields == ankified_note['fields']:
-                        num_no_change += 1
-                    else:
-                        anki.update_note(ankified_note, note_id)
-                        num_updated += 1
-                else:
-                    anki.add_note(ankified_note)
-                    num_added += 1
-                # Suspend or unsuspend the anki note
-                if ankified_note['suspend'] == True:
-                    anki.suspend_note(ankified_note)
-                elif ankified_note['suspend'] == False:
-                    anki.unsuspend_note(ankified_note)
-            except:
-                logger.exception(f"Failed ankifying {block} during upload to anki")
-                num_failed += 1
-        logger.info(f"Results: {num_added} notes added, {num_updated} updated, {num_no_change} unchanged, {num_failed} failed")
+                await client.run_steps(self._upload_steps(notes, notes_diff, *args))
+            finally:
+                uploads_in_flight.release()
+        loop = asyncio.get_running_loop()
+        tasks = []
+        try:
+            while True:
+                await uploads_in_flight.acquire()
+                # Wait for the next batch in a thread so uploads carry on meanwhile
+                item = await loop.run_in_executor(None, next, diffs, None)
+                if item is None:
+                    break
+                tasks.append(asyncio.ensure_future(upload(*item)))
+            await asyncio.gather(*tasks)
+        finally:
+            await client.close()
+        return client.stats
+
+    def _diff_steps(self, notes, counts, existing_notes):
+        """Look up a batch of notes in Anki and see which are new or changed
+
+        A generator of ActionBatches to send with `anki.run_steps`. Returns a
+        dict with each note's position in `notes` mapped to its uid ("uids"), 
+        its id in Anki ("note_ids", None for new notes) and its card ids when 
+        already known ("existing_cards"), and the positions of the notes to add 
+        or update ("to_upload"). Notes which failed are left out of "note_ids".
+
+        Args:
+            notes (list of tuple): Blocks and the anki notes made from them
+            counts (Counter): Counts of notes unchanged and failed
+            existing_notes (dict): Notes already in Anki from `anki.get_notes_by_uid`,
+                or from `SyncState.get_notes` with a "noteHash" instead of 
+                "fields". Notes which aren't in it are looked up by uid.
+        """
+        uids = {}
+        note_ids = {}
+        existing_fields = {}
+        existing_cards = {}
+        unchanged = set()
+        for i, (block, note) in enumerate(notes):
+            try:
+                uids[i] = note['fields']['uid']
+                existing_note = existing_notes.get(uids[i])
+                if existing_note:
+                    note_ids[i] = existing_note["noteId"]
+                    existing_cards[i] = existing_note.get("cards")
+                    if "fields" in existing_note:
+                        existing_fields[i] = existing_note["fields"]
+                    elif existing_note["noteHash"] == note_hash(note):
+                        unchanged.add(i)
+            except Exception:
+                self._log_failure(block, counts)
+                uids.pop(i, None)
+                note_ids.pop(i, None)
+
+        # Look for the other notes in Anki
+        batch = anki.ActionBatch()
+        actions = {i: batch.add("findNotes", query=f"uid:{uid}") 
+                   for i, uid in uids.items() if i not in note_ids}
+        yield batch
+        for i, action in actions.items():
+            ok, res = self._get_result(notes[i][0], action, counts)
+            if ok:
+                note_ids[i] = res[0] if res else None
+        actions = {i: batch.add("notesInfo", notes=[note_ids[i]]) for i in actions if note_ids.get(i)}
+        yield batch
+        for i, action in actions.items():
+            ok, res = self._get_result(notes[i][0], action, counts)
+            if ok:
+                try:
+                    existing_fields[i] = {k: v['value'] for k,v in res[0]['fields'].items()}
+                except Exception:
+                    # e.g. the note was deleted since it was found
+                    self._log_failure(notes[i][0], counts)
+                    ok = False
+            if not ok:
+                del note_ids[i]
+
+        # See which notes are new or changed
+        to_upload = []
+        for i in sorted(note_ids):
+            if not note_ids[i]:
+                to_upload.append(i)
+            elif i in unchanged or existing_fields.get(i) == notes[i][1]['fields']:
+                counts["no_change"] += 1
+            else:
+                to_upload.append(i)
+        return {"uids": uids, "note_ids": note_ids, "existing_cards": existing_cards, "to_upload": to_upload}
+
+    def _upload_steps(self, notes, diff, counts, suspend_cards, synced):
+        """Add or update anki notes, sending each step for the whole batch in one request
+
+        A generator of ActionBatches to send with `anki.run_steps` or 
+        `AsyncAnkiConnectClient.run_steps`.
+
+        Args:
+            notes (list of tuple): Blocks and the anki notes made from them
+            diff (dict): What `_diff_steps` returned for the notes
+            counts (Counter): Counts of notes added, updated and failed
+            suspend_cards (dict): Card ids to suspend under True and to unsuspend 
+                under False. The cards of notes with a suspend option are added to it.
+            synced (dict): The note id and `note_hash` of each note which is now 
+                in sync with Anki, including unchanged notes, are added to it by uid
+        """
+        uids = diff["uids"]
+        note_ids = dict(diff["note_ids"])
+        existing_cards = diff["existing_cards"]
+        to_upload = list(diff["to_upload"])
+        batch = anki.ActionBatch()
+
+        # Store images before the notes which show them
+        actions = {i: [batch.add("storeMediaFile", **image) for image in notes[i][1].pop("images", [])] 
+                   for i in to_upload}
+        yield batch
+        for i, image_actions in actions.items():
+            for action in image_actions:
+                ok, _ = self._get_result(notes[i][0], action, counts)
+                if not ok:
+                    to_upload.remove(i)
+                    del note_ids[i]
+                    break
+
+        # Add the new notes with addNotes and update the rest
+        to_add = [i for i in to_upload if not note_ids[i]]
+        to_update = [i for i in to_upload if note_ids[i]]
+        added = yield from anki.add_notes_steps([notes[i][1] for i in to_add], batch_size=self.batch_size)
+        updated = yield from anki.update_notes_fields_steps([(note_ids[i], notes[i][1]["fields"]) for i in to_update])
+        actions = dict(zip(to_add + to_update, added + updated))
+        new_ids = {}
+        for i, action in actions.items():
+            ok, res = self._get_result(notes[i][0], action, counts)
+            if ok:
+                new_ids[i] = res
+            else:
+                del note_ids[i]
+
+        # Collect the cards to suspend or unsuspend. New notes' cards start out 
+        # unsuspended, so they only need looking up when they should be suspended.
+        card_ids = {}
+        find_cards = {}
+        hashes = {}
+        for i in list(note_ids):
+            block, note = notes[i]
+            try:
+                hashes[i] = note_hash(note)
+                if note['suspend'] in [True, False]:
+                    if existing_cards.get(i) is not None:
+                        card_ids[i] = existing_cards[i]
+                    elif note_ids[i] or note['suspend']:
+                        find_cards[i] = note['suspend']
+            except Exception:
+                self._log_failure(block, counts)
+                del note_ids[i]
+        actions = {i: batch.add("findCards", query=f"uid:{uids[i]}") for i in find_cards}
+        yield batch
+        for i, action in actions.items():
+            ok, res = self._get_result(notes[i][0], action, counts)
+            if ok:
+                card_ids[i] = res
+            else:
+                del note_ids[i]
+        for i, cards in card_ids.items():
+            suspend_cards[notes[i][1]['suspend']].extend(cards)
+
+        # Count and record each note once, after every step for it succeeded
+        for i in note_ids:
+            if i in new_ids:
+                counts["updated" if note_ids[i] else "added"] += 1
+            synced[uids[i]] = (note_ids[i] or new_ids[i], hashes[i])
+
+    @staticmethod
+    def _update_suspended(suspend_cards):
+        try:
+            suspended, unsuspended = anki.update_suspended(suspend_cards[True], suspend_cards[False])
+        except:
+            logger.exception("Failed suspending and unsuspending cards")
+            return
+        logger.info(f"Suspended {len(suspended)} cards and unsuspended {len(unsuspended)} cards")
+
+    @staticmethod
+    def _get_result(block, action, counts):
+        "Return whether a batched action succeeded and its result, logging any error"
+        try:
+            return True, action.result()
+        except:
+            RoamGraphAnkifier._log_failure(block, counts)
+            return False, None
+
+    @staticmethod
+    def _log_failure(block, counts):
+        "Log the exception being handled as the block's failure and count it"
+        logger.exception(f"Failed ankifying {block} during upload to anki")
+        counts["failed"] += 1
+
+    @staticmethod
+    def _log_request_stats(stats):
+        message = f"AnkiConnect: {stats['requests']} requests, {stats['retries']} retried, {stats['failed']} failed"
+        if stats["paused_seconds"]:
+            message += f", paused {stats['paused_seconds']:.0f} seconds while AnkiConnect wasn't responding"
+        if stats["retries"] or stats["failed"]:
+            logger.warning(message)
+        else:
+            logger.info(message)
+
+    @staticmethod
+    def _log_tag_cache_stats(start, num_blocks):
+        end = roam.Block.tag_cache_info()
+        hits = end["hits"] - start["hits"]
+        misses = end["misses"] - start["misses"]
+        per_note = misses / num_blocks if num_blocks else 0
+        logger.debug(f"Tag cache: {hits} hits, {misses} misses ({per_note:.1f} tag computations per note)")
+
+
+# Blocks to convert and the BlockAnkifier to convert them with in worker processes
+_worker_blocks = None
+_worker_ankifier = None
+
+def _init_conversion_worker(blocks, block_ankifier, client):
+    global _worker_blocks, _worker_ankifier
+    _worker_blocks, _worker_ankifier = blocks, block_ankifier
+    # Use a new connection rather than the one inherited from the parent process
+    anki.configure(client.host, client.port, client.timeout, client.retries, client.backoff)
+
+def _convert_blocks_in_worker(span):
+    "Convert the blocks in a range of positions, returning each note or the formatted error"
+    results = []
+    for block in _worker_blocks[slice(*span)]:
+        try:
+            results.append((_worker_ankifier.ankify(block), None))
+        except Exception:
+            results.append((None, traceback.format_exc()))
+    return results
+
+
+class BlockOptions:
+    "Options for converting a block to an anki note, from its option tags or else the ankifier's settings"
+    def __init__(self, note=None, deck="Default", pageref_cloze="outside", num_parents=0, include_page=False, max_depth=None, download_imgs='never', suspend=None):
+        # Note type set on the block, or None to choose one from its content
+        self.note = note
+        self.deck = deck
+        self.pageref_cloze = pageref_cloze
+        self.num_parents = num_parents
+        self.include_page = include_page
+        self.max_depth = max_depth
+        self.download_imgs = download_imgs
+        # Whether to suspend (True) or unsuspend (False) the note's cards, or None to leave them
+        self.suspend = suspend
+
+    def __eq__(self, other):
+        return type(self)==type(other) and vars(self)==vars(other)
+
+    def __repr__(self):
+        return "<%s(%s)>" % (self.__class__.__name__, ", ".join(f"{k}={v!r}" for k, v in vars(self).items()))
+
+
+class OptionResolver:
+    """Parse the option tags of blocks, e.g. #[[ankify: deck=Biology]]
+
+    Options are read from every tag of a block and its parents in one pass, 
+    with the block's own tags taking precedence over its parents', and their 
+    parents' over tags from the block's "tags::" attribute. Each block's and 
+    page's options are cached, so sibling blocks share their parents' work.
+    """
+    def __init__(self, option_keys=["ankify", "ankify_roam"], from_attr=False):
+        self.from_attr = from_attr
+        self.pattern = re.compile(f'''^(\[\[)?({"|".join(option_keys)})(\]\])?:\s*(\S+?)\s?=\s?(.*)$''')
+        self._cache = {}
+        self._cache_version = roam.Block.cache_version()
+
+    def resolve(self, obj):
+        "Return a dict of the option values set on a block or page and its parents, as strings"
+        if self._cache_version != roam.Block.cache_version():
+            self._cache.clear()
+            self._cache_version = roam.Block.cache_version()
+        options = self._cache.get(obj)
+        if options is None:
+            options = self._cache[obj] = self._resolve(obj)
+        return options
+
+    def _resolve(self, obj):
+        if isinstance(obj, roam.Page):
+            return self.parse(obj.get_tags(from_attr=self.from_attr))
+        own_tags = obj.get_tags(inherit=False)
+        attr_tags = obj.get_tags(inherit=False, from_attr=True)[len(own_tags):] if self.from_attr else []
+        parent_options = self.resolve(obj.parent) if isinstance(obj.parent, (roam.Block, roam.Page)) else {}
+        return {**self.parse(attr_tags), **parent_options, **self.parse(own_tags)}
+
+    def parse(self, tags):
+        "Return a dict of the options set by a list of tags, keeping the first value of each"
+        options = {}
+        for tag in tags:
+            m = self.pattern.match(tag)
+            if m and m.group(4) not in options:
+                res = m.group(5)
+                # Remove surrounding quotes
+                if res.startswith("'") and res.endswith("'"):
+                    res = res[1:-1]
+                elif res.startswith('"') and res.endswith('"'):
+                    res = res[1:-1]
+                options[m.group(4)] = res
+        return options
+
+
+def _parse_bool(opt, default):
+    if opt == 'True':
+        return True
+    if opt == 'False':
+        return False
+    return default
+
+def _parse_num_parents(opt, default):
+    if opt:
+        if opt == "all":
+            return opt
+        try:
+            return int(opt)
+        except ValueError:
+            pass
+    return default
+
+def _parse_max_depth(opt, default):
+    if opt:
+        if opt=="None":
+            return None
+        if re.match("^([1-9]?\d+|0)$", opt):
+            return int(opt)
+    return default
 
 
 class BlockAnkifier:
@@ -128,27 +641,32 @@ class BlockAnkifier:
         self.field_names = field_names 
         self.tags_from_attr = tags_from_attr
         self.download_imgs = download_imgs
+        self._option_resolver = OptionResolver(option_keys, tags_from_attr)
+        self.media_manifest = anki.MediaManifest()
+        # Filenames of images downloaded by this ankifier, by URL
+        self._downloaded_imgs = {}
 
     def ankify(self, block, **kwargs):
         tags = block.get_tags(from_attr=self.tags_from_attr)
-        modelName = self._get_note_type(block)
-        deckName = self._get_deck(block)
+        options = self.get_options(block)
+        modelName = self._get_note_type(block, options)
+        deckName = options.deck
         if modelName not in self.field_names.keys():
             self.field_names[modelName] = anki.get_field_names(modelName)
         flashcard_type = self._get_flashcard_type(modelName)
-        kwargs["pageref_cloze"] = self._get_pageref_cloze(block)
-        kwargs["num_parents"] = self._get_num_parents(block)
-        kwargs["include_page"] = self._get_include_page(block)
-        kwargs["max_depth"] = self._get_max_depth(block)
+        kwargs["pageref_cloze"] = options.pageref_cloze
+        kwargs["num_parents"] = options.num_parents
+        kwargs["include_page"] = options.include_page
+        kwargs["max_depth"] = options.max_depth
         fields = self._block_to_fields(block, self.field_names[modelName], flashcard_type, **kwargs)
         res = {
             "deckName": deckName,
             "modelName": modelName,
             "fields": fields,
             "tags": self.ankify_tags(tags),
-            "suspend": self._get_suspend(block)
+            "suspend": options.suspend
         }
-        download_imgs = self._get_download_imgs(block)
+        download_imgs = options.download_imgs
         if download_imgs != 'never':
             overwrite = download_imgs == 'always'
             new_fields, images, errors = self.download_images(fields, overwrite)
@@ -164,77 +682,83 @@ class BlockAnkifier:
         
     def download_images(self, fields, overwrite=False):
         new_fields, images, errors = {}, {}, []
+        contents, downloaded = {}, {}
         for name, field in fields.items():
             soup = BeautifulSoup(field, 'html.parser')
             for img in soup.find_all("img"):
                 # Get image filename (if part of the filename is URL encoded, split by "%2F" and take the last part)
                 filename = os.path.basename(urlparse(img['src']).path).split("%2F")[-1]
-                # Skip images that have already been downloaded
-                if filename in images.keys() or (anki.found_media(filename) and not overwrite):
-                    img['src'] = filename
-                    continue
-                # Download images
                 try:
+                    # Skip images that have already been downloaded
+                    if filename in images.keys() or (not overwrite and filename in self.media_manifest):
+                        img['src'] = filename
+                        continue
+                    if img['src'] in self._downloaded_imgs:
+                        img['src'] = self._downloaded_imgs[img['src']]
+                        continue
+                    # Download images
                     res = requests.get(img['src'])
                     if res.status_code != 200:
                         raise ValueError(f"Download of '{img['src']}' failed with return code {res.status_code}")
-                    data = base64.b64encode(res.content).decode()
-                    images[filename] = {
-                        "data": data,
-                        "filename": filename
-                    }
-                    img['src'] = filename
+                    # Point to an image with the same content instead of storing it again
+                    stored_filename = self.media_manifest.find(res.content) or next(
+                        (f for f, content in contents.items() if content == res.content), None)
+                    if stored_filename is None:
+                        stored_filename = filename
+                        data = base64.b64encode(res.content).decode()
+                        images[filename] = {
+                            "data": data,
+                            "filename": filename
+                        }
+                        contents[filename] = res.content
+                    downloaded[img['src']] = stored_filename
+                    img['src'] = stored_filename
                 except Exception as e:
                     errors.append(e)
             new_fields[name] = str(soup)
         images = [data for _, data in images.items()]
+        # Only remember the images if they're going to be stored with the note
+        if not errors:
+            for filename, content in contents.items():
+                self.media_manifest.add(filename, content)
+            self._downloaded_imgs.update(downloaded)
 
         return new_fields, images, errors
 
     def _get_suspend(self, block):
-        opt = self._get_option(block, "suspend")
-        if opt == 'True':
-            return True
-        if opt == 'False':
-            return False
-        return None
+        return self.get_options(block).suspend
 
     def ankify_tags(self, roam_tags):
         return [re.sub(r"\s+","_",tag) for tag in roam_tags]
 
     def _get_option(self, block, option):
-        pat = f'''^(\[\[)?({"|".join(self.option_keys)})(\]\])?:\s*{option}\s?=\s?(.*)$'''
-        for tag in block.get_tags(from_attr=self.tags_from_attr):
-            m = re.match(pat, tag)
-            if m:
-                res = m.groups()[-1]
-                # Remove surrounding quotes
-                if res.startswith("'") and res.endswith("'"):
-                    res = res[1:-1]
-                elif res.startswith('"') and res.endswith('"'):
-                    res = res[1:-1]
-                return res
-        return None
-
-    def _get_note_type(self, block):
+        return self._option_resolver.resolve(block).get(option)
+
+    def get_options(self, block):
+        "Return the BlockOptions of a block, using this ankifier's settings for options it doesn't set"
+        opts = self._option_resolver.resolve(block)
+        return BlockOptions(
+            note=opts.get("note") or None,
+            deck=opts.get("deck") or self.deck,
+            pageref_cloze=opts.get("pageref-cloze") or self.pageref_cloze,
+            num_parents=_parse_num_parents(opts.get("num-parents"), self.num_parents),
+            include_page=_parse_bool(opts.get("include-page"), self.include_page),
+            max_depth=_parse_max_depth(opts.get("max-depth"), self.max_depth),
+            download_imgs=opts.get("download-imgs") or self.download_imgs,
+            suspend=_parse_bool(opts.get("suspend"), None),
+        )
+
+    def _get_note_type(self, block, options=None):
         # Search for assigned model
-        opt = self._get_option(block, "note")
-        if opt:
-            return opt
+        options = options or self.get_options(block)
+        if options.note:
+            return options.note
         # Otherwise infer from cloze markup
         if any([type(obj)==roam.Cloze for obj in block.get_contents(recursive=True)]):
             return self.note_cloze
         else:
             return self.note_basic
 
-    def _get_deck(self, block):
-        opt = self._get_option(block, "deck")
-        return opt or self.deck
-
-    def _get_pageref_cloze(self, block):
-        opt = self._get_option(block, "pageref-cloze")
-        return opt or self.pageref_cloze
-
     def _get_flashcard_type(self, modelName):
         # Infer from blocks assigned model name 
         if re.search("[Cc]loze", modelName):
@@ -242,39 +766,6 @@ class BlockAnkifier:
         else:
             return "basic"
 
-    def _get_num_parents(self, block):
-        num_parents = self._get_option(block, "num-parents")
-        if num_parents:
-            if num_parents == "all":
-                return num_parents
-            try:
-                return int(num_parents)
-            except ValueError:
-                pass
-        return self.num_parents
-
-    def _get_include_page(self, block):
-        opt = self._get_option(block, "include-page")
-        if opt:
-            if opt == 'True':
-                return True
-            if opt == 'False':
-                return False
-        return self.include_page
-
-    def _get_max_depth(self, block):
-        opt = self._get_option(block, "max-depth")
-        if opt:
-            if opt=="None":
-                return None
-            if re.match("^([1-9]?\d+|0)$", opt):
-                return int(opt)
-        return self.max_depth
-
-    def _get_download_imgs(self, block):
-        opt = self._get_option(block, "download-imgs")
-        return opt or self.download_imgs
-
     def _block_to_fields(self, block, field_names, flashcard_type, **kwargs):
         # Convert block content to html
         htmls = []
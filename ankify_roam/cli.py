@@ -11,6 +11,7 @@ from ankify_roam.default_models import ROAM_BASIC, ROAM_CLOZE, add_default_model
 from ankify_roam.ankifiers import RoamGraphAnkifier
 from ankify_roam.roam import RoamGraph
 from ankify_roam import util
+from ankify_roam.sync_state import DEFAULT_PATH as DEFAULT_SYNC_STATE_PATH
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -54,6 +55,18 @@ def main():
     )
     parser.add_argument('--version', action='version',
                         version='%(prog)s {version}'.format(version=get_version()))
+    parser.add_argument('--anki-host', default=anki.DEFAULT_HOST,
+                        type=str, action='store',
+                        help='Host AnkiConnect is listening on (default: "%(default)s")')
+    parser.add_argument('--anki-port', default=anki.DEFAULT_PORT,
+                        type=int, action='store',
+                        help='Port AnkiConnect is listening on (default: "%(default)s")')
+    parser.add_argument('--anki-timeout', default=anki.DEFAULT_TIMEOUT,
+                        type=float, action='store',
+                        help='Seconds to wait for AnkiConnect to respond to a request (default: "%(default)s")')
+    parser.add_argument('--anki-retries', default=anki.DEFAULT_RETRIES,
+                        type=int, action='store',
+                        help='Times to retry a request when AnkiConnect can\'t be reached (default: "%(default)s")')
 
     subparsers = parser.add_subparsers(help='sub-command help')
 
@@ -104,6 +117,18 @@ def main():
                         type=str, action='store',
                         choices=["once", "always", "never"],
                         help='Whether to download images embedded in blocks and save in anki')
+    parser_add.add_argument('--jobs', default=default_args['jobs'],
+                        type=int, action='store',
+                        help='Number of processes to convert blocks to notes with (default: %(default)s)')
+    parser_add.add_argument('--max-in-flight', default=default_args['max_in_flight'],
+                        type=int, action='store',
+                        help='Upload up to this many batches of notes to AnkiConnect at once, while the next blocks are converted (default: upload one batch at a time)')
+    parser_add.add_argument('--sync-state', default=default_args['sync_state'], 
+                        nargs='?', const=DEFAULT_SYNC_STATE_PATH, type=str, action='store',
+                        help='Remember which blocks were synced in this file, and skip blocks which haven\'t changed since the last sync (default file: "%(const)s")')
+    parser_add.add_argument('--full', default=default_args['full'],
+                        action='store_true',
+                        help='Sync every block, even the ones which haven\'t changed since the last sync')
     parser_add.set_defaults(func=add)
 
     # Arguments for initializer
@@ -115,6 +140,8 @@ def main():
     parser_init.set_defaults(func=init_models)
 
     args = vars(parser.parse_args())
+    anki.configure(host=args.pop("anki_host"), port=args.pop("anki_port"), 
+                   timeout=args.pop("anki_timeout"), retries=args.pop("anki_retries"))
 
     # If no arguments were given, print the help message and exit
     if len(args)==0:
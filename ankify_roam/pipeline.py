@@ -0,0 +1,152 @@
+"""Run stages of work in threads connected by bounded queues"""
+import time
+import queue
+import threading
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+class StageStats:
+    "Items handled by a stage, the time it spent working and the depth of its input queue"
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self._queue_depth_total = 0
+        self._queue_depth_samples = 0
+
+    def record_queue_depth(self, depth):
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        self._queue_depth_total += depth
+        self._queue_depth_samples += 1
+
+    @property
+    def mean_queue_depth(self):
+        return self._queue_depth_total / self._queue_depth_samples if self._queue_depth_samples else 0
+
+    @property
+    def throughput(self):
+        "Items per second of work"
+        return self.items / self.busy_seconds if self.busy_seconds else 0
+
+    def __str__(self):
+        res = f"{self.name} {self.items} at {self.throughput:.0f}/s"
+        if self._queue_depth_samples:
+            res += f" (queue max {self.max_queue_depth}, mean {self.mean_queue_depth:.1f})"
+        return res
+
+
+class _Stopped(Exception):
+    "Raised in a stage's thread when another stage failed"
+
+
+class Pipeline:
+    """Run stages in their own threads, each feeding the next through a bounded queue
+
+    The first stage is a function which takes no arguments and returns an
+    iterable. Each later stage is a function which takes an iterator over the
+    previous stage's output, and may return an iterable for the next stage.
+    A full queue blocks the stage feeding it, so a slow stage holds back the
+    stages before it instead of letting work pile up.
+
+    If a stage raises an exception, the other stages are stopped and `run`
+    raises it.
+
+    Args:
+        maxsize (int): Number of items each queue holds
+    """
+    def __init__(self, maxsize=2):
+        self.maxsize = maxsize
+        self.stages = []
+        self.stats = []
+        self._stop = threading.Event()
+        self._error = None
+
+    def add_stage(self, name, func, size=None):
+        """Add a stage which runs after the stages already added
+
+        Args:
+            size (function): Returns the number of items in each input, e.g.
+                `len` for batches. For the first stage, it's applied to outputs.
+        """
+        self.stages.append((func, size or (lambda item: 1)))
+        self.stats.append(StageStats(name))
+
+    def run(self):
+        "Run every stage until the last one finishes and return their StageStats"
+        queues = [queue.Queue(self.maxsize) for _ in self.stages[1:]]
+        threads = []
+        for i, (func, size) in enumerate(self.stages):
+            in_queue = queues[i - 1] if i > 0 else None
+            out_queue = queues[i] if i < len(queues) else None
+            next_stats = self.stats[i + 1] if out_queue else None
+            thread = threading.Thread(
+                target=self._run_stage, name=f"pipeline-{self.stats[i].name}",
+                args=(func, size, self.stats[i], in_queue, out_queue, next_stats), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.stats
+
+    def _run_stage(self, func, size, stats, in_queue, out_queue, next_stats):
+        start = time.perf_counter()
+        waiting = [0.0]
+        try:
+            if in_queue is None:
+                outputs = func()
+            else:
+                outputs = func(self._iter_queue(in_queue, size, stats, waiting))
+            for item in outputs or []:
+                if in_queue is None:
+                    stats.items += size(item)
+                if out_queue is not None:
+                    put_start = time.perf_counter()
+                    self._put(out_queue, item)
+                    waiting[0] += time.perf_counter() - put_start
+                    next_stats.record_queue_depth(out_queue.qsize())
+        except _Stopped:
+            pass
+        except BaseException as e:
+            if self._error is None:
+                self._error = e
+            self._stop.set()
+        finally:
+            stats.busy_seconds = time.perf_counter() - start - waiting[0]
+            if out_queue is not None:
+                try:
+                    self._put(out_queue, _DONE)
+                except _Stopped:
+                    pass
+
+    def _iter_queue(self, in_queue, size, stats, waiting):
+        while True:
+            get_start = time.perf_counter()
+            item = self._get(in_queue)
+            waiting[0] += time.perf_counter() - get_start
+            if item is _DONE:
+                return
+            stats.items += size(item)
+            yield item
+
+    def _put(self, out_queue, item):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                return out_queue.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def _get(self, in_queue):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
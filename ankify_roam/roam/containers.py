@@ -1,9 +1,11 @@
 import re
 import os
+import io
 import json
 from zipfile import ZipFile
 import logging
 from ankify_roam.roam.content import *
+from ankify_roam.util import iter_json_array
 
 logger = logging.getLogger(__name__)
 
@@ -13,48 +15,84 @@ class RoamGraph:
         for page in pages:
             self.pages.append(Page.from_dict(page, self))
         self.propagate_parents()
+        self.index_pages()
+        self.index_blocks()
 
     @classmethod
-    def from_path(cls, path):
+    def from_path(cls, path, stream=True):
         path = os.path.expanduser(path)
         if os.path.isdir(path):
-            return cls.from_dir(path)
+            return cls.from_dir(path, stream=stream)
         elif os.path.splitext(path)[-1]==".zip":
-            return cls.from_zip(path)
+            return cls.from_zip(path, stream=stream)
         elif os.path.splitext(path)[-1]==".json":
-            return cls.from_json(path)
+            return cls.from_json(path, stream=stream)
         else:
             raise ValueError(f"'{path}' must be refer to a directory, zip, or json")
 
     @classmethod
-    def from_json(cls, path):
+    def from_json(cls, path, stream=True):
+        """
+        Args:
+            stream (bool): Read and convert one page at a time instead of loading 
+                the whole export into memory first
+        """
         with open(path, encoding='utf-8') as f:
+            if stream:
+                return cls(iter_json_array(f))
             roam_pages = json.load(f)
         return cls(roam_pages)
     
     @classmethod
-    def from_zip(cls, path):
+    def from_zip(cls, path, stream=True):
         with ZipFile(path, 'r') as zip_ref:
             filename = zip_ref.namelist()[0]
             if os.path.splitext(filename)[-1]==".md":
                 raise ValueError("Roam export must be JSON while the provided is markdown")
             with zip_ref.open(filename) as f:
+                if stream:
+                    return cls(iter_json_array(io.TextIOWrapper(f, encoding='utf-8')))
                 roam_pages = json.load(f)
         return cls(roam_pages)
 
     @classmethod
-    def from_dir(cls, path):
+    def from_dir(cls, path, stream=True):
         "Initialize using the latest roam export in the given directory"
         roam_exports = [f for f in os.listdir(path) if re.match("Roam-Export-.*", f)]
         if len(roam_exports)==0:
             raise ValueError(f"'{path}' doesn't contain any Roam export zip files")
         filename = sorted(roam_exports)[-1]
-        return cls.from_zip(os.path.join(path,filename))
-
-    def get_page(self, title):
+        return cls.from_zip(os.path.join(path,filename), stream=stream)
+
+    def get_page(self, title, case_sensitive=True):
+        if len(self.pages) != self._num_indexed_pages:
+            # Pages were added to self.pages directly
+            self.index_pages()
+        if case_sensitive:
+            return self.pages_by_title.get(title)
+        return self.pages_by_folded_title.get(title.casefold())
+
+    def add_page(self, page):
+        "Add a page to the graph and its indexes"
+        self.pages.append(page)
+        page.propagate_parents()
+        self._index_page(page)
+        self._num_indexed_pages += 1
+        for block in page.iter_blocks():
+            self._index_block(block)
+        self._tag_queries = {}
+
+    def index_pages(self):
+        "Map page titles to pages, keeping the first page when titles are duplicated"
+        self.pages_by_title = {}
+        self.pages_by_folded_title = {}
         for page in self.pages:
-            if page.title==title:
-                return page
+            self._index_page(page)
+        self._num_indexed_pages = len(self.pages)
+
+    def _index_page(self, page):
+        self.pages_by_title.setdefault(page.title, page)
+        self.pages_by_folded_title.setdefault(page.title.casefold(), page)
 
     def query_many(self, condition):
         blocks = []
@@ -63,17 +101,78 @@ class RoamGraph:
         return blocks
 
     def query_by_uid(self, uid):
+        return self.blocks_by_uid.get(uid)
+
+    def index_blocks(self):
+        "Map block uids to blocks. Call again after adding, removing or editing blocks"
+        Block.invalidate_caches()
+        self.blocks_by_uid = {}
+        self._block_order = {}
+        self._tag_queries = {}
         for page in self.pages:
-            block = page.query_by_uid(uid)
-            if block:
-                return block
+            for block in page.iter_blocks():
+                self._index_block(block)
 
-    def query_by_tag(self, tag):
-        return self.query_many(lambda b: tag in b.get_tags())
+    def _index_block(self, block):
+        # Keep the first block when uids are duplicated
+        if block.uid not in self.blocks_by_uid:
+            self.blocks_by_uid[block.uid] = block
+            self._block_order[block.uid] = len(self._block_order)
+
+    def get_blocks(self, uids):
+        "Return the blocks with the given uids in the order they appear in the graph"
+        uids = sorted([uid for uid in uids if uid in self.blocks_by_uid], key=self._block_order.get)
+        return [self.blocks_by_uid[uid] for uid in uids]
+
+    def query_by_tag(self, tag, inherit=True, from_attr=False, exclude=None):
+        """Return blocks with the given tag
+
+        Args:
+            inherit (bool): Include blocks which inherit the tag from a parent
+            from_attr (bool): Include tags listed in "tags::" attributes
+            exclude (str): Skip blocks with this tag, including inherited tags
+        """
+        uids = self._get_tagged_uids(tag, inherit, from_attr)
+        if exclude:
+            uids = uids - self._get_tagged_uids(exclude, True, from_attr)
+        return self.get_blocks(uids)
+
+    def _get_tagged_uids(self, tag, inherit, from_attr):
+        # Queries are cached until any block is edited or moved
+        version = Block.cache_version()
+        cached = self._tag_queries.get((tag, from_attr))
+        if cached is None or cached[0] != version:
+            cached = (version, self._find_tagged_uids(tag, from_attr))
+            self._tag_queries[(tag, from_attr)] = cached
+        direct_uids, inherited_uids = cached[1]
+        return inherited_uids if inherit else direct_uids
+
+    def _find_tagged_uids(self, tag, from_attr):
+        "Find the blocks with a tag, only parsing the blocks which might have it"
+        direct_uids, inherited_uids = set(), set()
+        def visit(block, parent_has_tag):
+            has_tag = block.might_have_tag(tag, from_attr) and \
+                tag in block.get_tags(inherit=False, from_attr=from_attr)
+            if has_tag:
+                direct_uids.add(block.uid)
+            if has_tag or parent_has_tag:
+                inherited_uids.add(block.uid)
+            for child in block.children:
+                visit(child, has_tag or parent_has_tag)
+        for page in self.pages:
+            page_has_tag = page.might_have_tag(tag, from_attr) and \
+                tag in page.get_tags(from_attr=from_attr)
+            for block in page.children:
+                visit(block, page_has_tag)
+        return direct_uids, inherited_uids
 
     def propagate_parents(self):
         for page in self.pages:
             page.propagate_parents()
+        # Cache the ancestors of each block once all the parents are set
+        for page in self.pages:
+            for block in page.iter_blocks():
+                block._get_parents()
 
 
 class Page:
@@ -83,6 +182,25 @@ class Page:
         self.edit_time = edit_time
         self.edit_email = edit_email
 
+    @property
+    def title(self):
+        return self._title
+
+    @title.setter
+    def title(self, title):
+        # Blocks on the page inherit the title as a tag
+        self._title = title
+        Block.invalidate_caches()
+
+    @property
+    def children(self):
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        self._children = children
+        Block.invalidate_caches()
+
     def get_attribute(self, key, default=None):
         for o in self.children:
             if o.content and type(o.content[0]) == Attribute and o.content[0].title == key:
@@ -101,6 +219,12 @@ class Page:
     def get(self, key, default=None):
         return getattr(self, key) if hasattr(self, key) else default
 
+    def might_have_tag(self, tag, from_attr=False):
+        "Return False when the page can't have the tag, without parsing its blocks"
+        if tag == self.title:
+            return True
+        return from_attr and any(tag in block.string for block in self.children)
+
     def query_by_uid(self, uid, default=None, blocks=None):
         if blocks is None: blocks = self.get('children',[])
         for block in blocks:
@@ -120,6 +244,13 @@ class Page:
             res += self.query_many(condition, blocks=block.children)
         return res
 
+    def iter_blocks(self, blocks=None):
+        "Yield every block on the page in document order"
+        if blocks is None: blocks=self.get('children',[])
+        for block in blocks:
+            yield block
+            yield from self.iter_blocks(blocks=block.children)
+
     def num_descendants(self):
         count = 0
         for block in self.children:
@@ -146,10 +277,31 @@ class Page:
 
 
 class Block:
+    # Bumped whenever the content or children of any block, or the title or 
+    # children of any page, is replaced. The counter is shared by every block, 
+    # so any edit invalidates the tags cached on every block in every graph, not 
+    # only those below the edited block
+    structure_version = 0
+    # Bumped whenever the parent of any block is replaced, which invalidates the
+    # ancestors and inherited tags cached on every block
+    parent_version = 0
+    tag_cache_stats = {"hits": 0, "misses": 0}
+
     def __init__(self, content=None, children=None, uid="", create_time="", 
                  create_email="",  edit_time="", edit_email="", roam_db=None, 
-                 parent=None):
-        self.content = content or BlockContent()
+                 parent=None, string=None):
+        """
+        Args:
+            string (str): Block string to parse into the content the first time it's 
+                needed. Only used when content isn't given.
+        """
+        self._tags_cache = {}
+        self._parents_cache = None
+        if content is None and string is not None:
+            self._content = None
+            self._string = string
+        else:
+            self.content = content or BlockContent()
         self.children = children or BlockChildren()
         self.uid = uid
         self.create_time = create_time
@@ -161,26 +313,114 @@ class Block:
         self.objects = []
         self.parent = parent
 
+    @property
+    def content(self):
+        if self._content is None:
+            try:
+                self._content = BlockContent.from_string(self._string, roam_db=self.roam_db)
+            except Exception:
+                logger.exception(f"Unknown problem parsing block '{self.uid}' :(. Keeping it as text")
+                self._content = BlockContent(self._string)
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+        Block.invalidate_caches()
+
+    @property
+    def string(self):
+        "The block string, which doesn't require parsing the content"
+        if self._content is None:
+            return self._string
+        return self._content.to_string()
+
+    def is_parsed(self):
+        return self._content is not None
+
+    def might_have_tag(self, tag, from_attr=False):
+        """Return False when the block can't have the tag, without parsing it
+
+        Tags are always written out in the block string, so the block can only have 
+        the tag if the string contains it. Tags from attributes are in the strings 
+        of the children.
+        """
+        if tag in self.string:
+            return True
+        return from_attr and any(tag in child.string for child in self.children)
+
+    @property
+    def children(self):
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        self._children = children
+        Block.invalidate_caches()
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent):
+        if hasattr(self, "_parent") and parent is self._parent:
+            return
+        self._parent = parent
+        Block.parent_version += 1
+
+    @staticmethod
+    def invalidate_caches():
+        "Call after editing the content or children of a block in place"
+        Block.structure_version += 1
+
+    @staticmethod
+    def cache_version():
+        "Return a value which changes whenever any block is edited or moved"
+        return (Block.structure_version, Block.parent_version)
+
+    @staticmethod
+    def tag_cache_info():
+        "Return how often `get_tags` was answered from the cache"
+        return dict(Block.tag_cache_stats)
+
     @property
     def parents(self):
-        if isinstance(self.parent, Page):
-            return [self.parent]
-        elif isinstance(self.parent, Block):
-            return [self.parent] + self.parent.parents
-        return []
+        return list(self._get_parents())
 
     @property
     def parent_blocks(self):
-        if isinstance(self.parent, Block):
-            return [self.parent] + self.parent.parent_blocks
-        return []
+        parents = self._get_parents()
+        if parents and isinstance(parents[-1], Page):
+            parents = parents[:-1]
+        return list(parents)
 
     @property
     def parent_page(self):
-        parent = self.parent
-        while parent and not isinstance(parent, Page):
-            parent = parent.parent
-        return parent
+        parents = self._get_parents()
+        if parents and isinstance(parents[-1], Page):
+            return parents[-1]
+        return None
+
+    @property
+    def depth(self):
+        "Number of blocks above this one, so top level blocks have a depth of 0"
+        parents = self._get_parents()
+        if parents and isinstance(parents[-1], Page):
+            return len(parents) - 1
+        return len(parents)
+
+    def _get_parents(self):
+        "Return a tuple of the parent, grandparent, etc. up to the page"
+        if self._parents_cache is None or self._parents_cache[0] != Block.parent_version:
+            if isinstance(self.parent, Page):
+                parents = (self.parent,)
+            elif isinstance(self.parent, Block):
+                parents = (self.parent,) + self.parent._get_parents()
+            else:
+                parents = ()
+            self._parents_cache = (Block.parent_version, parents)
+        return self._parents_cache[1]
 
     def get(self, key, default=None):
         if not default: default=BlockChildren()
@@ -206,6 +446,20 @@ class Block:
         Returns:
             list of string: Tags on the block
         """
+        version = Block.cache_version()
+        cached = self._tags_cache.get((inherit, from_attr))
+        if cached and cached[0] == version:
+            Block.tag_cache_stats["hits"] += 1
+            tags = list(cached[1])
+        else:
+            Block.tag_cache_stats["misses"] += 1
+            tags = self._get_tags(inherit, from_attr)
+            self._tags_cache[(inherit, from_attr)] = (version, tuple(tags))
+        if drop_duplicates:
+            tags = list(dict.fromkeys(tags)) # This preserves order
+        return tags
+
+    def _get_tags(self, inherit, from_attr):
         tags = self.content.get_tags()
         if inherit:
             if isinstance(self.parent, Page):
@@ -218,8 +472,6 @@ class Block:
             # Get tags listed as attribute
             bc = self.get_attribute("tags", [])
             tags += bc.get_tags() if bc else []
-        if drop_duplicates:
-            tags = list(dict.fromkeys(tags)) # This preserves order
         return tags
 
     def get_contents(self, recursive=False):
@@ -273,7 +525,6 @@ class Block:
     @classmethod
     def from_dict(cls, block, roam_db=None):
         # TODO: rename this
-        content = BlockContent.from_string(block["string"], roam_db=roam_db)
         child_block_objects = []
         for child_block in block.get("children",[]):
             try:
@@ -282,9 +533,9 @@ class Block:
                 logger.error(f"Unknown problem parsing block '{child_block['uid']}' :(. Skipping")
                 logger.debug(e, exc_info=1)
         children = BlockChildren(child_block_objects)
-        return cls(content, children, block['uid'], block.get('create-time',''),
+        return cls(None, children, block['uid'], block.get('create-time',''),
                    block.get('create-email',''), block.get('edit-time',''), block.get('edit-email',''), 
-                   roam_db)
+                   roam_db, string=block["string"])
 
     @classmethod
     def from_string(cls, string, *args, **kwargs):
@@ -10,6 +10,21 @@ import html
 logger = logging.getLogger(__name__)
 
 RE_SPLIT_OR = "(?<!\\\)\|"
+RE_PAGE_REF_BRACKETS = re.compile(r"\[\[|\]\]")
+RE_PAGE_TAG = re.compile(r"#[\w\-_@\.]+")
+RE_ALIAS_PREFIX = re.compile(r"\[[^\[\]]+\]\(")
+RE_BRACKET_RUN = re.compile(r"\[{3,}")
+RE_PAGE_REF_LINK = re.compile(r"(?:#|\[[^\[\]]+\]\()(?=\[\[)")
+
+# Patterns which don't depend on the string being parsed, compiled once at import
+STATIC_PATTERNS = {}
+
+
+def register_patterns(*classes):
+    """Compile the search and validation patterns of BlockContentItem types"""
+    for cls in classes:
+        STATIC_PATTERNS[(cls, False)] = re.compile(cls.create_pattern(None))
+        STATIC_PATTERNS[(cls, True)] = re.compile(cls.create_validation_pattern(None))
 
 
 def split_string_at_spans(string, spans):
@@ -73,8 +88,16 @@ class BlockContent(list):
         return cls(roam_objects)
 
     @classmethod
-    def from_string(cls, string, *args, **kwargs):
-        return cls.find_and_replace(string, *args, **kwargs)
+    def from_string(cls, string, *args, tokenize=True, **kwargs):
+        """
+        Args:
+            string (str): Roam markup to parse
+            tokenize (bool): Parse with the single-pass BlockContentTokenizer. Set to
+                False to use the original pass-per-type `find_and_replace`.
+        """
+        if tokenize:
+            return BlockContentTokenizer(*args, **kwargs).tokenize(string)
+        return cls.find_and_replace(string, *args, tokenize=False, **kwargs)
 
     def get_tags(self):
         tags = []
@@ -164,6 +187,9 @@ class BlockContent(list):
 
 
 class BlockContentItem:
+    # Whether `create_pattern` builds the pattern from the string being searched
+    dynamic_pattern = False
+
     @classmethod
     def from_string(cls, string, validate=True):
         if validate and not cls.validate_string(string):
@@ -171,11 +197,29 @@ class BlockContentItem:
 
     @classmethod
     def validate_string(cls, string):
-        pat = "^(?:%s)$" % cls.create_pattern(string)
-        if re.match(re.compile(pat), string):
+        if cls.get_pattern(string, validate=True).match(string):
             return True
         return False
 
+    @classmethod
+    def create_validation_pattern(cls, string):
+        return "^(?:%s)$" % cls.create_pattern(string)
+
+    @classmethod
+    def get_pattern(cls, string=None, validate=False):
+        """Return the compiled pattern which finds this object in `string`
+
+        Static patterns come from STATIC_PATTERNS. Dynamic ones are built from 
+        `string` and compiled each time.
+
+        Args:
+            validate (bool): Return the pattern which matches the whole string instead
+        """
+        if not cls.dynamic_pattern:
+            return STATIC_PATTERNS[(cls, validate)]
+        pat = cls.create_validation_pattern(string) if validate else cls.create_pattern(string)
+        return re.compile(pat) if pat else None
+
     def to_string(self):
         raise NotImplementedError
 
@@ -190,10 +234,10 @@ class BlockContentItem:
 
     @classmethod
     def find_substring_locs(cls, string):
-        pat = cls.create_pattern(string)
+        pat = cls.get_pattern(string)
         if not pat:
             return []
-        return [m.span() for m in re.finditer(pat, string)]
+        return [m.span() for m in pat.finditer(string)]
 
     @classmethod
     def find_and_replace(cls, string, *args, **kwargs):
@@ -661,17 +705,32 @@ class Alias(BlockContentItem):
 
     @classmethod
     def find_substring_locs(cls, string):
-        pat_template = r"\[[^\[\]]+\]\((?:%s)\)"
-        substring_locs = []
-        for obj in [PageRef, BlockRef, Url]:
-            dest_pat = obj.create_pattern(string)
-            pat = pat_template % dest_pat
-            obj_locs = [m.span() for m in re.finditer(pat, string)]
-            if obj == PageRef:
-                obj_locs = [span for span in obj_locs if "\n" not in string[span[0]:span[1]]]
-            substring_locs += obj_locs
+        substring_locs = cls._find_page_ref_alias_locs(string)
+        for pat in [RE_ALIAS_BLOCK_REF, RE_ALIAS_URL]:
+            substring_locs += [m.span() for m in pat.finditer(string)]
         return sorted(substring_locs, key=lambda x: x[0])
 
+    @staticmethod
+    def _find_page_ref_alias_locs(string):
+        page_refs = set(PageRef.extract_page_ref_strings(string))
+        if not page_refs:
+            return []
+        max_len = max(len(p) for p in page_refs)
+        substring_locs = []
+        pos = 0
+        while True:
+            m = RE_ALIAS_PREFIX.search(string, pos)
+            if not m:
+                break
+            end = PageRef.find_page_ref_end(string, m.end(), m.end() + max_len)
+            if end is not None and string[m.end():end] in page_refs and string[end:end+1] == ")":
+                if "\n" not in string[m.start():end]:
+                    substring_locs.append((m.start(), end+1))
+                pos = end + 1
+            else:
+                pos = m.start() + 1
+        return substring_locs
+
     def __eq__(self, other):
         return type(self)==type(other) and self.alias==other.alias and other.destination==other.destination
 
@@ -753,6 +812,8 @@ class CodeBlock(BlockContentItem):
 
 
 class CodeInline(BlockContentItem):
+    CODE_PATTERN = re.compile("`([^`]*)`")
+
     def __init__(self, code, string=None):
         self.code = code
         self.string = string
@@ -760,8 +821,7 @@ class CodeInline(BlockContentItem):
     @classmethod
     def from_string(cls, string, **kwargs):
         super().from_string(string)
-        pat = re.compile("`([^`]*)`")
-        code = re.search(pat, string).group(1)
+        code = cls.CODE_PATTERN.search(string).group(1)
         return cls(code, string)
 
     @classmethod
@@ -947,6 +1007,8 @@ class Button(BlockContentItem):
 
 
 class PageRef(BlockContentItem):
+    dynamic_pattern = True
+
     def __init__(self, title, uid="", string=None):
         """
         Args:
@@ -1029,39 +1091,90 @@ class PageRef(BlockContentItem):
             f'<span class="rm-page-ref-brackets">]]</span>'\
             f'</span>'
 
+    @classmethod
+    def validate_string(cls, string):
+        return string.startswith("[[") and PageRef.find_page_ref_end(string, 0) == len(string)
+
+    @classmethod
+    def find_substring_locs(cls, string):
+        spans, unclosed_start = PageRef.extract_page_ref_spans(string)
+        if unclosed_start is None:
+            return spans
+        # An unclosed page ref swallows the rest of the string, but page refs found
+        # before it still match inside it
+        page_refs = {string[i:j] for i, j in spans}
+        if not page_refs:
+            return spans
+        max_len = max(len(p) for p in page_refs)
+        pos = unclosed_start
+        while True:
+            pos = string.find("[[", pos)
+            if pos == -1:
+                break
+            end = PageRef.find_page_ref_end(string, pos, pos + max_len)
+            if end is not None and string[pos:end] in page_refs:
+                spans.append((pos, end))
+                pos = end
+            else:
+                pos += 1
+        return spans
+
     @staticmethod
-    def extract_page_ref_strings(string):
-        # https://stackoverflow.com/questions/524548/regular-expression-to-detect-semi-colon-terminated-c-for-while-loops/524624#524624
+    def find_page_ref_end(string, pos, endpos=None):
+        """Return the end of the page ref opened by the '[[' at `pos`
+
+        Brackets are paired from left to right, so '[[[' opens a single page ref 
+        and nested page refs are closed before the page ref they're in.
+
+        Args:
+            endpos (int): Index the page ref must end before
+
+        Returns:
+            int: Index after the closing ']]' or None if it isn't closed
+        """
+        if endpos is None or endpos > len(string): endpos = len(string)
         bracket_count = 0
-        pages = []
-        page = ""
-        prev_char = ""
-        for j,c in enumerate(string):
-            # Track page opening and closing
-            if prev_char+c == "[[":
-                if not page:
-                    page = string[j-1]
+        for m in RE_PAGE_REF_BRACKETS.finditer(string, pos, endpos):
+            bracket_count += 1 if m.group() == "[[" else -1
+            if bracket_count == 0:
+                return m.end()
+        return None
+
+    @staticmethod
+    def extract_page_ref_spans(string):
+        """Find the outermost page refs in a single pass over the string
+
+        Returns:
+            tuple: list of (start, end) spans of the page refs and the start of the 
+                page ref left unclosed at the end of the string, or None
+        """
+        spans = []
+        bracket_count = 0
+        start = None
+        for m in RE_PAGE_REF_BRACKETS.finditer(string):
+            if m.group() == "[[":
+                if bracket_count == 0:
+                    start = m.start()
                 bracket_count += 1
-                prev_char = ""
-            elif page and prev_char+c == "]]":
+            elif bracket_count > 0:
                 bracket_count -= 1
-                prev_char = ""
-            else:
-                prev_char = c
-            if page:
-                page += c
-            # End of page
-            if bracket_count == 0 and page:
-                pages.append(page)
-                page = ""
+                if bracket_count == 0:
+                    spans.append((start, m.end()))
+                    start = None
+        return spans, start
 
-        return pages
+    @staticmethod
+    def extract_page_ref_strings(string):
+        spans, _ = PageRef.extract_page_ref_spans(string)
+        return [string[i:j] for i, j in spans]
 
     def __eq__(self, other):
         return type(self)==type(other) and self.title==other.title
 
 
 class PageTag(BlockContentItem):
+    dynamic_pattern = True
+
     def __init__(self, title, string=None):
         """
         Args:
@@ -1103,6 +1216,37 @@ class PageTag(BlockContentItem):
             f'<span data-tag="{html.escape(self.title)}" '\
             f'class="rm-page-ref rm-page-ref-tag">#{html.escape(self.title)}</span>'
 
+    @classmethod
+    def validate_string(cls, string):
+        if RE_PAGE_TAG.fullmatch(string):
+            return True
+        return string.startswith("#[[") and PageRef.find_page_ref_end(string, 1) == len(string)
+
+    @classmethod
+    def find_substring_locs(cls, string):
+        page_refs = set(PageRef.extract_page_ref_strings(string))
+        max_len = max([len(p) for p in page_refs], default=0)
+        spans = []
+        pos = 0
+        while True:
+            pos = string.find("#", pos)
+            if pos == -1:
+                break
+            m = RE_PAGE_TAG.match(string, pos)
+            if m:
+                spans.append(m.span())
+                pos = m.end()
+                continue
+            end = None
+            if page_refs and string.startswith("[[", pos+1):
+                end = PageRef.find_page_ref_end(string, pos+1, pos+1+max_len)
+            if end is not None and string[pos+1:end] in page_refs:
+                spans.append((pos, end))
+                pos = end
+            else:
+                pos += 1
+        return spans
+
     @classmethod
     def create_pattern(cls, string):
         pats = ["#[\w\-_@\.]+"]
@@ -1227,11 +1371,8 @@ class Attribute(BlockContentItem):
         return cls(string[:-2], string)
 
     @classmethod
-    def validate_string(cls, string):
-        pat = re.compile(cls.create_pattern(string)+"$")
-        if re.match(pat, string):
-            return True
-        return False
+    def create_validation_pattern(cls, string=None):
+        return cls.create_pattern(string) + "$"
 
     @classmethod
     def create_pattern(cls, string=None):
@@ -1250,3 +1391,261 @@ class Attribute(BlockContentItem):
 
     def __eq__(self, other):
         return type(self)==type(other) and self.title==other.title
+
+
+register_patterns(BlockQuote, ClozeLeftBracket, ClozeRightBracket, ClozeHint, Image, 
+                  CodeInline, Checkbox, View, Embed, Button, BlockRef, Url, Attribute)
+RE_ALIAS_BLOCK_REF = re.compile(r"\[[^\[\]]+\]\((?:%s)\)" % BlockRef.create_pattern())
+RE_ALIAS_URL = re.compile(r"\[[^\[\]]+\]\((?:%s)\)" % Url.create_pattern())
+
+
+class BlockContentTokenizer:
+    """Split a block string into BlockContent in a single left-to-right scan
+
+    `BlockContent.find_and_replace` runs one regex pass per BlockContentItem type, 
+    each pass rescanning every String left over by the previous ones. This produces 
+    the same BlockContent, but only runs the block quote, code and cloze passes when 
+    the characters they need are in the string, then finds all the remaining inline 
+    objects in one scan by dispatching on the character each object starts with.
+
+    Objects are matched at the leftmost position first and, when several types match 
+    at a position, in the same priority order as `BlockContent.find_and_replace`. A 
+    match is cut short at the start of any higher priority object inside it, since 
+    that object would have been split out first by the multi-pass parser. 
+
+    The multi-pass parser pairs the brackets of page references separately in each 
+    String left over by the earlier passes, and lets an unclosed page reference 
+    swallow the rest of its String. The scan pairs them once for the whole string, 
+    so strings with an unclosed page reference, with a page reference split by an 
+    object of higher priority inside it, like '[[a [[b]] #c]]', or with an alias or 
+    #[[tag]] inside a page reference are parsed with the multi-pass parser instead. 
+    They're rare, and this way both parsers always give the same BlockContent.
+    """
+    def __init__(self, skip=[], **kwargs):
+        """
+        Args:
+            skip (list of BlockContentItem types): Types to leave as strings
+            **kwargs: Passed on to the `from_string` method of each object
+        """
+        self.skip = skip
+        self.kwargs = kwargs
+        self.inline_types = [t for t in self.INLINE_TYPES if t not in skip]
+        self.first_chars = "".join(dict.fromkeys(
+            self.FIRST_CHARS[t] for t in self.inline_types))
+        self.trigger = re.compile("[%s]" % re.escape(self.first_chars)) if self.first_chars else None
+        self._page_ref_ends = {}
+        self._split_page_ref = False
+
+    def tokenize(self, string):
+        if not string:
+            return BlockContent()
+        if BlockQuote not in self.skip and string.startswith(">"):
+            return BlockContent([BlockQuote.from_string(string, **self.kwargs)])
+
+        roam_objects = BlockContent([String(string)])
+        if "`" in string:
+            for obj_type in [CodeBlock, CodeInline]:
+                if obj_type not in self.skip:
+                    roam_objects = obj_type.find_and_replace(roam_objects, **self.kwargs)
+        if Cloze not in self.skip and ("{" in string or "}" in string):
+            roam_objects = Cloze.find_and_replace(roam_objects, **self.kwargs)
+
+        res = []
+        for obj in roam_objects:
+            if type(obj) == String:
+                res += self._tokenize_inline(obj.to_string())
+            else:
+                res.append(obj)
+        return BlockContent(res)
+
+    def _tokenize_inline(self, string):
+        self._page_ref_ends = self._pair_page_ref_brackets(string)
+        res = self._scan_inline(string)
+        if res is None:
+            skip = self.skip + [BlockQuote, CodeBlock, CodeInline, Cloze]
+            res = list(BlockContent.find_and_replace(String(string), skip=skip, **self.kwargs))
+        return res
+
+    def _scan_inline(self, string):
+        "Return the objects in the string, or None when it needs the multi-pass parser"
+        if None in self._page_ref_ends.values() or self._has_nested_page_ref_link(string):
+            return None
+        self._split_page_ref = False
+        res = []
+        pos = 0
+        while pos < len(string):
+            start, end, obj_type = self._next_object(string, pos)
+            if self._split_page_ref:
+                return None
+            res += self._tokenize_plain(string[pos:start])
+            if obj_type is None:
+                break
+            res.append(obj_type.from_string(string[start:end], **self.kwargs))
+            pos = end
+        return res
+
+    def _tokenize_plain(self, string):
+        "Split out the objects which can only be found in text between other objects"
+        res = []
+        if Attribute not in self.skip:
+            m = Attribute.get_pattern().match(string)
+            if m:
+                res.append(Attribute.from_string(m.group(), **self.kwargs))
+                string = string[m.end():]
+        if Url not in self.skip:
+            spans = [m.span() for m in Url.get_pattern().finditer(string)]
+            urls = [Url.from_string(string[i:j], **self.kwargs) for i, j in spans]
+            strings = [String(s) for s in split_string_at_spans(string, spans)]
+            res += [a for b in zip_longest(strings, urls) for a in b if a]
+        elif string:
+            res.append(String(string))
+        return [o for o in res if o.to_string()]
+
+    def _next_object(self, string, pos):
+        """Find the leftmost object at or after `pos`
+
+        Returns:
+            tuple: start, end and type of the object, or (len(string), len(string), None)
+        """
+        n = len(string)
+        while self.trigger:
+            m = self.trigger.search(string, pos)
+            if not m:
+                break
+            start = m.start()
+            for priority, obj_type in enumerate(self.inline_types):
+                if self.FIRST_CHARS[obj_type] != string[start]:
+                    continue
+                end = self._match(obj_type, string, start, n)
+                while end is not None:
+                    # Objects of higher priority are split out first, so only match 
+                    # up to the start of the first one inside this object
+                    inner_start = self._find_higher_priority(string, start, end, priority)
+                    if inner_start is None:
+                        return start, end, obj_type
+                    if self._page_ref_crosses(start, inner_start):
+                        self._split_page_ref = True
+                        return n, n, None
+                    end = self._match(obj_type, string, start, inner_start)
+            pos = start + 1
+        return n, n, None
+
+    def _find_higher_priority(self, string, start, end, priority):
+        "Return the start of the first object of higher priority inside string[start:end]"
+        higher_types = self.inline_types[:priority]
+        first_chars = {self.FIRST_CHARS[t] for t in higher_types}
+        for i in range(start+1, end):
+            if string[i] not in first_chars:
+                continue
+            for obj_type in higher_types:
+                if self.FIRST_CHARS[obj_type] == string[i] and \
+                   self._match(obj_type, string, i, len(string), nested=True) is not None:
+                    return i
+        return None
+
+    def _match(self, obj_type, string, pos, endpos, nested=False):
+        """Return the end of the `obj_type` object starting at `pos` or None
+
+        Args:
+            endpos (int): Index the object must end before
+            nested (bool): Whether `pos` is inside another object. Page references 
+                only match when they aren't nested in another page reference.
+        """
+        if obj_type == PageRef:
+            if nested or not string.startswith("[[", pos, endpos):
+                return None
+            return self._find_page_ref_end(string, pos, endpos)
+        if obj_type == PageTag:
+            m = RE_PAGE_TAG.match(string, pos, endpos)
+            if m:
+                return m.end()
+            if nested or not string.startswith("[[", pos+1, endpos):
+                return None
+            return self._find_page_ref_end(string, pos+1, endpos)
+        if obj_type == Alias:
+            m = RE_ALIAS_PREFIX.match(string, pos, endpos)
+            if not m:
+                return None
+            if string.startswith("[[", m.end(), endpos):
+                end = self._find_page_ref_end(string, m.end(), endpos)
+                if end is not None and string[end:end+1] == ")" and end < endpos \
+                   and "\n" not in string[pos:end]:
+                    return end + 1
+                return None
+            for pat in [RE_ALIAS_BLOCK_REF, RE_ALIAS_URL]:
+                m = pat.match(string, pos, endpos)
+                if m:
+                    return m.end()
+            return None
+        m = obj_type.get_pattern().match(string, pos, endpos)
+        return m.end() if m else None
+
+    def _find_page_ref_end(self, string, pos, endpos):
+        "Like `PageRef.find_page_ref_end`, but looked up in the brackets paired for the whole string"
+        end = self._page_ref_ends.get(pos)
+        return end if end is not None and end <= endpos else None
+
+    @staticmethod
+    def _pair_page_ref_brackets(string):
+        """Map the start of each '[[' in the string to the end of the ']]' closing it
+
+        Pairs brackets the way `PageRef.find_page_ref_end` does from each '[[', in 
+        one pass instead of one scan per '[['. Unclosed page refs map to None.
+        """
+        ends = {}
+        open_starts = []
+        for m in RE_PAGE_REF_BRACKETS.finditer(string):
+            if m.group() == "[[":
+                ends[m.start()] = None
+                open_starts.append(m.start())
+            elif open_starts:
+                ends[open_starts.pop()] = m.end()
+        # Scanning from an odd offset into a run of '[' pairs the run's brackets 
+        # differently, but the page ref opened there is closed by the same ']]' 
+        # as one of the '[[' paired above
+        for m in RE_BRACKET_RUN.finditer(string):
+            run_start, run_len = m.start(), len(m.group())
+            for offset in range(1, run_len - 1, 2):
+                num_opened = (run_len - offset) // 2
+                ends[run_start + offset] = ends[run_start + 2 * (run_len // 2 - num_opened)]
+        return ends
+
+    @staticmethod
+    def _has_nested_page_ref_link(string):
+        """Whether an alias or #[[tag]] links to a page ref nested in another page ref
+
+        The multi-pass parser matches those by the text of the page refs which 
+        aren't nested, wherever they are.
+        """
+        if "#[[" not in string and "]([[" not in string:
+            return False
+        outermost = {start for start, _ in PageRef.extract_page_ref_spans(string)[0]}
+        return any(m.end() not in outermost for m in RE_PAGE_REF_LINK.finditer(string))
+
+    def _page_ref_crosses(self, start, pos):
+        "Whether a page ref opened in string[start:pos] is closed after `pos`"
+        return any(start <= i < pos < end for i, end in self._page_ref_ends.items())
+
+
+BlockContentTokenizer.INLINE_TYPES = [
+    Image,
+    Alias,
+    Checkbox,
+    Embed,
+    View,
+    Button,
+    PageTag,
+    PageRef,
+    BlockRef,
+]
+BlockContentTokenizer.FIRST_CHARS = {
+    Image: "!",
+    Alias: "[",
+    Checkbox: "{",
+    Embed: "{",
+    View: "{",
+    Button: "{",
+    PageTag: "#",
+    PageRef: "[",
+    BlockRef: "(",
+}
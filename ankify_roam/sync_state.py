@@ -0,0 +1,146 @@
+"""Remember which blocks were synced to Anki so later runs can skip them"""
+import os
+import re
+import json
+import hashlib
+import logging
+from ankify_roam.roam.containers import Block
+from ankify_roam.roam.content import BlockRef
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join("~", ".ankify_roam", "sync_state.json")
+
+# Bumped when the file layout changes, which makes the next run a full sync
+STATE_VERSION = 2
+
+BLOCK_REF_RE = re.compile(BlockRef.create_pattern())
+
+
+def block_hash(block, from_attr=False):
+    """Hash everything a block's note is made from, without parsing any blocks
+
+    That's the block and its descendants, its parents and page title, and the
+    blocks which any of those reference along with their descendants. With 
+    `from_attr`, the attribute blocks under its parents and page are included 
+    too. Blocks are hashed by uid, parent, edit time and string, so edits are 
+    noticed even in exports without edit times.
+
+    Returns:
+        tuple: The hash and the latest edit time of the blocks in it
+    """
+    h = hashlib.sha1()
+    seen = set()
+    edit_times = []
+
+    def add(b):
+        if b.uid in seen:
+            return False
+        seen.add(b.uid)
+        parent_uid = b.parent.uid if isinstance(b.parent, Block) else ""
+        h.update(f"{b.uid}\0{parent_uid}\0{b.edit_time}\0{b.string}\n".encode("utf-8"))
+        if b.edit_time:
+            edit_times.append(b.edit_time)
+        refs.extend(m[2:-2] for m in BLOCK_REF_RE.findall(b.string))
+        return True
+
+    def add_tree(b):
+        stack = [b]
+        while stack:
+            b = stack.pop()
+            if add(b):
+                stack.extend(reversed(b.children))
+
+    refs = []
+    add_tree(block)
+    page = block.parent_page
+    for parent in block.parent_blocks + ([page] if page and from_attr else []):
+        if isinstance(parent, Block):
+            add(parent)
+        if from_attr:
+            # Tags in a "tags::" attribute apply to the attribute's parent, 
+            # and those at the top of a page to every block on it
+            for child in parent.children:
+                if "::" in child.string:
+                    add(child)
+    h.update(f"page\0{page.title if page else ''}\n".encode("utf-8"))
+    while refs:
+        uid = refs.pop()
+        ref_block = block.roam_db.query_by_uid(uid) if block.roam_db else None
+        if ref_block is None:
+            h.update(f"missing\0{uid}\n".encode("utf-8"))
+        else:
+            add_tree(ref_block)
+    return h.hexdigest(), max(edit_times, default=None)
+
+
+def note_hash(anki_dict):
+    "Hash what's uploaded for a note: its fields, tags, deck and note type"
+    note = {key: anki_dict.get(key) for key in ["fields", "tags", "deckName", "modelName"]}
+    return hashlib.sha1(json.dumps(note, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class SyncState:
+    """Blocks synced to Anki in earlier runs, saved as JSON
+
+    Maps each block uid to the hash from `block_hash` when it was synced, the
+    latest edit time in it, and the id and `note_hash` of its note in Anki. 
+    Blocks synced with different settings, like another deck or note type, are 
+    forgotten.
+
+    Args:
+        path (str): JSON file to load from and save to
+        settings (dict): Options which change how notes are made
+    """
+    def __init__(self, path=DEFAULT_PATH, settings=None):
+        self.path = os.path.expanduser(path)
+        self.settings_hash = hashlib.sha1(
+            json.dumps(settings or {}, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        self.blocks = {}
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return self
+        except (OSError, ValueError):
+            logger.warning(f"Couldn't read sync state from '{self.path}', syncing every block")
+            return self
+        if state.get("version") != STATE_VERSION or state.get("settings") != self.settings_hash:
+            logger.info("Settings changed since the last sync, syncing every block")
+            return self
+        self.blocks = state.get("blocks", {})
+        return self
+
+    def save(self):
+        "Write the state to a temporary file first so a failed write keeps the old state"
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": STATE_VERSION, "settings": self.settings_hash, "blocks": self.blocks}, f)
+        os.replace(tmp_path, self.path)
+
+    def is_synced(self, uid, content_hash, note_id):
+        "Whether the block was synced with the same hash to a note which is still in Anki"
+        synced = self.blocks.get(uid)
+        return bool(synced and note_id and synced["content_hash"] == content_hash
+                    and synced["note_id"] == note_id)
+
+    def get_notes(self, note_ids):
+        """Return the synced notes which are still in Anki, without asking Anki for their fields
+
+        Args:
+            note_ids (iterable): Ids of the notes in Anki
+
+        Returns:
+            dict: Maps the uid of each block to a dict with its note's "noteId" 
+                and "noteHash", like `anki.get_notes_by_uid` without the fields
+        """
+        note_ids = set(note_ids)
+        return {uid: {"noteId": synced["note_id"], "noteHash": synced["note_hash"]} 
+                for uid, synced in self.blocks.items() if synced["note_id"] in note_ids}
+
+    def record(self, uid, content_hash, edit_time, note_id, note_hash):
+        self.blocks[uid] = {"content_hash": content_hash, "edit_time": edit_time, 
+                            "note_id": note_id, "note_hash": note_hash}
@@ -1,4 +1,9 @@
 import inspect
+import json
+import re
+
+WHITESPACE = " \t\n\r"
+RE_WHITESPACE = re.compile(r"[ \t\n\r]*")
 
 
 def get_default_args(func):
@@ -10,5 +15,73 @@ def get_default_args(func):
     }
 
 
+def iter_json_array(f, chunk_size=1 << 16):
+    """Yield the items of the JSON array in a text file one at a time
+
+    Only the item being decoded is held in memory, rather than the whole array 
+    like `json.load`.
+
+    Args:
+        f: Text file object positioned at the start of a JSON array
+        chunk_size (int): Number of characters to read at a time
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def read(size):
+        nonlocal buf, pos, eof
+        chunk = f.read(size)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def next_char():
+        "Skip whitespace and return the next character, or '' at the end of the file"
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos:pos+1]
+            read(chunk_size)
+
+    if next_char() != "[":
+        raise json.JSONDecodeError("Expecting '['", buf, pos)
+    pos += 1
+    if next_char() == "]":
+        return
+    while True:
+        next_char()
+        size = chunk_size
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                item = end = None
+            # A value may have been cut short by the end of the buffer, e.g. a
+            # number, so only take it once the delimiter after it has been read
+            if end is not None:
+                delim = RE_WHITESPACE.match(buf, end).end()
+                if eof or (delim < len(buf) and buf[delim] in ",]"):
+                    break
+            # Read more on each retry so long items are decoded in linear time
+            read(size)
+            size *= 2
+        pos = end
+        yield item
+        item = None
+        c = next_char()
+        if c == "]":
+            return
+        if c != ",":
+            raise json.JSONDecodeError("Expecting ',' delimiter", buf, pos)
+        pos += 1
+
+
 if __name__=="__main__":
     add_default_models()
\ No newline at end of file
@@ -0,0 +1,79 @@
+"""Time AnkiConnect requests with and without a keep-alive connection
+
+Starts a local stand-in for AnkiConnect which answers every action with an empty
+result, then sends the same requests with a new urllib connection per request,
+which is how `anki._invoke` used to work, and with AnkiConnectClient.
+
+    python benchmarks/bench_anki_connect.py --requests 2000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ankify_roam import anki
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which Nagle's algorithm delays
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"result": [], "error": None}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def invoke_urlopen(url, action, **params):
+    request_json = json.dumps(anki._create_request_dict(action, **params)).encode("utf-8")
+    response = json.load(urllib.request.urlopen(urllib.request.Request(url, request_json)))
+    return anki._parse_response(response)
+
+
+def time_requests(invoke, num_requests):
+    latencies = []
+    for i in range(num_requests):
+        start = time.perf_counter()
+        invoke("findNotes", query=f"uid:{i:09d}")
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return sum(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("localhost", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    client = anki.AnkiConnectClient(host, port)
+    try:
+        for name, invoke in [
+            ("urlopen per request", lambda *a, **kw: invoke_urlopen(client.url, *a, **kw)),
+            ("keep-alive client", client.invoke),
+        ]:
+            total, median, p99 = time_requests(invoke, args.requests)
+            print(f"{name:20} {total:.2f}s total, median {median * 1e3:.2f} ms, p99 {p99 * 1e3:.2f} ms")
+    finally:
+        client.close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Time rendering a graph where most blocks contain block refs
+
+Compares looking up referenced blocks with the uid index on RoamGraph against
+walking every page for each lookup, which is how `query_by_uid` used to work.
+
+    python benchmarks/bench_block_refs.py --pages 100 --blocks 20
+"""
+import os
+import sys
+import time
+import random
+import string
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ankify_roam.roam.containers import RoamGraph
+
+
+def random_uid():
+    return "".join(random.choice(string.ascii_letters + string.digits) for _ in range(9))
+
+
+def make_pages(num_pages, blocks_per_page, refs_per_block):
+    """Build pages where every other block refs blocks which contain plain text
+
+    Block refs are expanded when rendered, so only plain blocks are referenced to 
+    keep refs from nesting.
+    """
+    uids = [[random_uid() for _ in range(blocks_per_page)] for _ in range(num_pages)]
+    plain_uids = [uid for page_uids in uids for uid in page_uids[::2]]
+    pages = []
+    for i, page_uids in enumerate(uids):
+        children = []
+        for j, uid in enumerate(page_uids):
+            if j % 2 == 0:
+                string = f"plain block {uid}"
+            else:
+                refs = " ".join(f"(({random.choice(plain_uids)}))" for _ in range(refs_per_block))
+                string = f"block with refs {refs}"
+            children.append({"string": string, "uid": uid})
+        pages.append({"title": f"page {i}", "children": children})
+    return pages
+
+
+class WalkingRoamGraph:
+    "Proxy which looks up uids by walking every page"
+    def __init__(self, roam_graph):
+        self.roam_graph = roam_graph
+
+    def query_by_uid(self, uid):
+        for page in self.roam_graph.pages:
+            block = page.query_by_uid(uid)
+            if block:
+                return block
+
+
+def render(roam_graph, roam_db):
+    blocks = [b for page in roam_graph.pages for b in page.iter_blocks()]
+    for block in blocks:
+        for obj in block.content:
+            if hasattr(obj, "roam_db"):
+                obj.roam_db = roam_db
+    start = time.perf_counter()
+    for block in blocks:
+        block.to_html()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--blocks", type=int, default=20, help="Blocks per page")
+    parser.add_argument("--refs", type=int, default=3, help="Block refs per block")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    roam_graph = RoamGraph(make_pages(args.pages, args.blocks, args.refs))
+    num_refs = args.pages * (args.blocks // 2) * args.refs
+    print(f"{args.pages} pages, {args.pages * args.blocks} blocks, {num_refs} block refs")
+
+    walk_time = render(roam_graph, WalkingRoamGraph(roam_graph))
+    print(f"walking pages: {walk_time:.3f}s")
+    index_time = render(roam_graph, roam_graph)
+    print(f"uid index:     {index_time:.3f}s ({walk_time / index_time:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Time converting blocks to anki notes with different numbers of processes
+
+Builds a synthetic graph and converts every #ankify block the way
+`RoamGraphAnkifier.ankify` does, without uploading, for each value of --jobs.
+
+    python benchmarks/bench_convert.py --pages 500 --blocks 20 --jobs 1 2 4 8
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ankify_roam.roam.containers import RoamGraph
+from ankify_roam.ankifiers import RoamGraphAnkifier, BlockAnkifier
+
+
+def make_pages(num_pages, blocks_per_page):
+    words = ["roam", "anki", "note", "card", "graph", "block", "page", "tag"]
+    pages = []
+    for i in range(num_pages):
+        children = []
+        for j in range(blocks_per_page):
+            text = " ".join(random.choice(words) for _ in range(15))
+            children.append({
+                "string": f"{text} **{random.choice(words)}** [[page {random.randrange(num_pages)}]] #ankify",
+                "uid": f"{i:05d}{j:04d}",
+                "children": [{"string": f"{{c1:{text}}} `{random.choice(words)}`", "uid": f"{i:05d}{j:04d}a"}],
+            })
+        pages.append({"title": f"page {i}", "children": children})
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--blocks", type=int, default=20, help="Blocks per page")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    pages = make_pages(args.pages, args.blocks)
+    field_names = {"Roam Basic": ["Front", "Back", "Extra", "uid"], "Roam Cloze": ["Text", "Back Extra", "uid"]}
+    print(f"{args.pages * args.blocks} blocks on {os.cpu_count()} CPUs")
+    base_time = None
+    for jobs in args.jobs:
+        # Use a new graph each time so blocks aren't already parsed
+        roam_graph = RoamGraph(pages)
+        blocks = roam_graph.query_by_tag("ankify", inherit=False)
+        ankifier = RoamGraphAnkifier(jobs=jobs)
+        block_ankifier = BlockAnkifier(field_names=field_names)
+        start = time.perf_counter()
+        with ankifier._conversion_pool(blocks, block_ankifier) as converted:
+            notes = list(ankifier._convert_blocks(blocks, block_ankifier, Counter(), converted))
+        elapsed = time.perf_counter() - start
+        base_time = base_time or elapsed
+        print(f"jobs={jobs:<3} {elapsed:.2f}s ({len(notes) / elapsed:.0f} notes/s, {base_time / elapsed:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Compare peak memory of loading a Roam export with and without streaming
+
+Writes a synthetic export and loads it in a fresh process for each mode,
+reporting the peak resident set size of each.
+
+    python benchmarks/bench_load_memory.py --pages 5000 --blocks 20
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ankify_roam.roam.containers import RoamGraph
+
+
+def make_pages(num_pages, blocks_per_page):
+    words = ["roam", "anki", "note", "card", "graph", "block", "page", "tag"]
+    for i in range(num_pages):
+        children = []
+        for j in range(blocks_per_page):
+            text = " ".join(random.choice(words) for _ in range(20))
+            string = f"{text} [[page {random.randrange(num_pages)}]] #{random.choice(words)}"
+            children.append({"string": string, "uid": f"{i:05d}-{j:03d}", "create-time": 0})
+        yield {"title": f"page {i}", "children": children, "edit-time": 0}
+
+
+def write_export(path, num_pages, blocks_per_page):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for i, page in enumerate(make_pages(num_pages, blocks_per_page)):
+            if i: f.write(",")
+            json.dump(page, f)
+        f.write("]")
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes
+    return peak / (1024**2 if sys.platform == "darwin" else 1024)
+
+
+def load(path, stream):
+    start = time.perf_counter()
+    roam_graph = RoamGraph.from_json(path, stream=stream)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"peak_rss_mb": peak_rss_mb(), "seconds": elapsed, "pages": len(roam_graph.pages)}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--pages", type=int, default=5000)
+    parser.add_argument("--blocks", type=int, default=20, help="Blocks per page")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--load", help=argparse.SUPPRESS)
+    parser.add_argument("--stream", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load:
+        return load(args.load, args.stream)
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "export.json")
+        write_export(path, args.pages, args.blocks)
+        size_mb = os.path.getsize(path) / 1024**2
+        print(f"{args.pages} pages, {args.pages * args.blocks} blocks, {size_mb:.1f} MB export")
+        for stream in [False, True]:
+            cmd = [sys.executable, __file__, "--load", path] + (["--stream"] if stream else [])
+            res = json.loads(subprocess.run(cmd, capture_output=True, check=True, text=True).stdout)
+            mode = "streaming" if stream else "json.load"
+            print(f"{mode:10} peak RSS {res['peak_rss_mb']:.0f} MB, {res['seconds']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Time ankifying a graph into the fake AnkiConnect server
+
+Builds a synthetic graph where every block is tagged #ankify and uploads it to
+FakeAnkiConnectServer, first into an empty collection and then again when
+every note is unchanged. `--latency` adds a delay to every request, to see how
+the number of requests and --max-in-flight affect a slow AnkiConnect.
+
+    python benchmarks/bench_upload.py --pages 100 --blocks 20 --latency 0.005
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ankify_roam import anki
+from ankify_roam.roam.containers import RoamGraph
+from ankify_roam.ankifiers import RoamGraphAnkifier
+from ankify_roam.default_models import add_default_models
+from tests.fake_anki import FakeAnkiConnectServer
+
+
+def make_pages(num_pages, blocks_per_page):
+    pages = []
+    for i in range(num_pages):
+        children = []
+        for j in range(blocks_per_page):
+            children.append({
+                "string": f"Question {j} on [[page {i}]] #ankify",
+                "uid": f"{i:05d}{j:04d}",
+                "children": [{"string": f"Answer {j}", "uid": f"{i:05d}{j:04d}a"}],
+            })
+        pages.append({"title": f"page {i}", "children": children})
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--blocks", type=int, default=20, help="Blocks per page")
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds added to each request")
+    parser.add_argument("--batch-size", type=int, default=anki.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--max-in-flight", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    pages = make_pages(args.pages, args.blocks)
+    print(f"{args.pages * args.blocks} notes, {args.latency * 1e3:.1f} ms latency per request")
+    with FakeAnkiConnectServer(latency=args.latency) as server:
+        anki.configure(server.host, server.port)
+        add_default_models()
+        ankifier = RoamGraphAnkifier(batch_size=args.batch_size, max_in_flight=args.max_in_flight)
+        for run in ["empty collection", "unchanged notes"]:
+            server.num_requests = 0
+            roam_graph = RoamGraph(pages)
+            start = time.perf_counter()
+            ankifier.ankify(roam_graph)
+            elapsed = time.perf_counter() - start
+            rate = args.pages * args.blocks / elapsed
+            print(f"{run:17} {elapsed:.2f}s ({rate:.0f} notes/s), {server.num_requests} requests")
+
+
+if __name__ == "__main__":
+    main()
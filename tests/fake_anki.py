@@ -0,0 +1,359 @@
+"""In-process stand-in for AnkiConnect, for tests and benchmarks
+
+FakeAnki keeps decks, note types, notes, cards and media in memory and answers
+the AnkiConnect actions used by `anki`. FakeAnkiConnectServer serves it over
+HTTP on a background thread:
+
+    with FakeAnkiConnectServer(latency=0.005) as server:
+        anki.configure(server.host, server.port)
+        add_default_models()
+        RoamGraphAnkifier().ankify(roam_graph)
+        print(server.num_requests, server.actions)
+"""
+import re
+import json
+import time
+import base64
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ankify_roam.anki import DEFAULT_HOST
+
+
+class FakeAnki:
+    """An in-memory Anki collection which handles AnkiConnect actions
+
+    Errors are raised as exceptions with the messages AnkiConnect uses, so
+    `anki._parse_response` turns them into the same exception types.
+    """
+    def __init__(self, decks=["Default"], profiles=["User 1"]):
+        self.decks = list(decks)
+        self.profiles = list(profiles)
+        self.profile = self.profiles[0] if self.profiles else None
+        self.models = {}
+        self.notes = {}
+        self.cards = {}
+        self.media = {}
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    def handle(self, action, params):
+        "Run an action and return its result, raising an exception for errors"
+        with self._lock:
+            return self._get_method(action)(**params)
+
+    def _get_method(self, action):
+        # e.g. "findNotes" is handled by `action_find_notes`
+        method = getattr(self, "action_" + re.sub("([A-Z])", r"_\1", action or "").lower(), None)
+        if method is None:
+            raise Exception("unsupported action")
+        return method
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id - 1
+
+    def _get_model(self, name):
+        if name not in self.models:
+            raise Exception(f"model was not found: {name}")
+        return self.models[name]
+
+    def action_multi(self, actions):
+        results = []
+        for action in actions:
+            try:
+                result, error = self._get_method(action.get("action"))(**action.get("params", {})), None
+            except Exception as e:
+                result, error = None, str(e)
+            results.append({"result": result, "error": error})
+        return results
+
+    # Decks and profiles
+
+    def action_deck_names(self):
+        return list(self.decks)
+
+    def action_create_deck(self, deck):
+        if deck not in self.decks:
+            self.decks.append(deck)
+        return self.decks.index(deck) + 1
+
+    def action_delete_decks(self, decks, cardsToo=False):
+        for deck in decks:
+            if deck in self.decks:
+                self.decks.remove(deck)
+            for note_id in [i for i, n in self.notes.items() if n["deckName"] == deck]:
+                self._delete_note(note_id)
+
+    def action_get_profiles(self):
+        return list(self.profiles)
+
+    def action_load_profile(self, name):
+        if name not in self.profiles:
+            return False
+        self.profile = name
+        return True
+
+    # Note types
+
+    def action_model_names(self):
+        return list(self.models)
+
+    def action_model_field_names(self, modelName):
+        return list(self._get_model(modelName)["fields"])
+
+    def action_model_templates(self, modelName):
+        return {name: dict(template) for name, template in self._get_model(modelName)["templates"].items()}
+
+    def action_model_styling(self, modelName):
+        return {"css": self._get_model(modelName)["css"]}
+
+    def action_create_model(self, modelName, inOrderFields, cardTemplates, css="", isCloze=False):
+        if modelName in self.models:
+            raise Exception("Model name already exists")
+        templates = {t.get("Name", f"Card {i + 1}"): {"Front": t["Front"], "Back": t["Back"]}
+                     for i, t in enumerate(cardTemplates)}
+        self.models[modelName] = {"fields": list(inOrderFields), "templates": templates,
+                                  "css": css, "isCloze": isCloze}
+        return {"name": modelName, "id": self._new_id()}
+
+    def action_update_model_templates(self, model):
+        self._get_model(model["name"])["templates"].update(model["templates"])
+
+    def action_update_model_styling(self, model):
+        self._get_model(model["name"])["css"] = model["css"]
+
+    # Notes and cards
+
+    def action_find_notes(self, query):
+        return [note_id for note_id, note in self.notes.items() if self._matches(note, query)]
+
+    def action_find_cards(self, query):
+        return [card_id for note_id, note in self.notes.items() if self._matches(note, query)
+                for card_id in note["cards"]]
+
+    def _matches(self, note, query):
+        "Match a note against terms like `uid:abc`, `\"note:Roam Basic\"` and `deck:Default`, joined by `or`"
+        for term in re.split(r"\s+or\s+", query.strip(), flags=re.IGNORECASE):
+            term = term.strip().strip('"').replace('\\"', '"')
+            key, _, value = term.partition(":")
+            if not value:
+                if any(term.lower() in v.lower() for v in note["fields"].values()):
+                    return True
+            elif key.lower() == "note":
+                if note["modelName"].lower() == value.lower():
+                    return True
+            elif key.lower() == "deck":
+                if note["deckName"].lower() == value.lower():
+                    return True
+            elif key.lower() == "nid":
+                if str(note["noteId"]) in value.split(","):
+                    return True
+            elif note["fields"].get(key, "").lower() == value.lower():
+                return True
+        return False
+
+    def action_notes_info(self, notes):
+        return [self._note_info(note_id) if note_id in self.notes else {} for note_id in notes]
+
+    def _note_info(self, note_id):
+        note = self.notes[note_id]
+        field_names = self.models[note["modelName"]]["fields"] if note["modelName"] in self.models else list(note["fields"])
+        return {
+            "noteId": note_id,
+            "modelName": note["modelName"],
+            "tags": list(note["tags"]),
+            "fields": {name: {"value": note["fields"].get(name, ""), "order": i}
+                       for i, name in enumerate(field_names)},
+            "cards": list(note["cards"]),
+        }
+
+    def action_add_note(self, note):
+        model = self._get_model(note["modelName"])
+        if note.get("deckName", "Default") not in self.decks:
+            raise Exception(f"deck was not found: {note.get('deckName')}")
+        fields = {name: note["fields"].get(name, "") for name in model["fields"]}
+        first_field = fields[model["fields"][0]] if model["fields"] else ""
+        if not first_field.strip():
+            raise Exception("cannot create note because it is empty")
+        if not note.get("options", {}).get("allowDuplicate"):
+            for other in self.notes.values():
+                if other["modelName"] == note["modelName"] and other["fields"].get(model["fields"][0]) == first_field:
+                    raise Exception("cannot create note because it is a duplicate")
+        note_id = self._new_id()
+        if model["isCloze"]:
+            num_cards = len(set(re.findall(r"{{c(\d+)::", first_field))) or 1
+        else:
+            num_cards = len(model["templates"])
+        cards = [self._new_id() for _ in range(num_cards)]
+        self.notes[note_id] = {"noteId": note_id, "modelName": note["modelName"],
+                               "deckName": note.get("deckName", "Default"), "fields": fields,
+                               "tags": list(note.get("tags", [])), "cards": cards}
+        for card_id in cards:
+            self.cards[card_id] = {"note": note_id, "suspended": False}
+        return note_id
+
+    def action_add_notes(self, notes):
+        results, errors = [], []
+        for note in notes:
+            try:
+                results.append(self.action_add_note(note))
+            except Exception as e:
+                errors.append(str(e))
+        # Like newer versions of AnkiConnect, fail the whole action when any
+        # note can't be added, though the other notes are still added
+        if errors:
+            raise Exception(str(errors))
+        return results
+
+    def action_update_note_fields(self, note):
+        if note["id"] not in self.notes:
+            raise Exception("Note was not found: {}".format(note["id"]))
+        self.notes[note["id"]]["fields"].update(note["fields"])
+
+    def action_add_tags(self, notes, tags):
+        for note_id in notes:
+            note_tags = self.notes[note_id]["tags"]
+            note_tags.extend(t for t in tags.split() if t.lower() not in [n.lower() for n in note_tags])
+
+    def action_remove_tags(self, notes, tags):
+        remove = {t.lower() for t in tags.split()}
+        for note_id in notes:
+            self.notes[note_id]["tags"] = [t for t in self.notes[note_id]["tags"] if t.lower() not in remove]
+
+    def _delete_note(self, note_id):
+        for card_id in self.notes.pop(note_id)["cards"]:
+            self.cards.pop(card_id, None)
+
+    def action_suspend(self, cards):
+        return self._set_suspended(cards, True)
+
+    def action_unsuspend(self, cards):
+        return self._set_suspended(cards, False)
+
+    def _set_suspended(self, cards, suspended):
+        changed = False
+        for card_id in cards:
+            if card_id in self.cards and self.cards[card_id]["suspended"] != suspended:
+                self.cards[card_id]["suspended"] = suspended
+                changed = True
+        return changed
+
+    def action_are_suspended(self, cards):
+        return [self.cards[c]["suspended"] if c in self.cards else None for c in cards]
+
+    # Media
+
+    def action_store_media_file(self, filename, data=None, url=None, path=None, deleteExisting=True):
+        if data is None and url is None and path is None:
+            raise Exception("You must provide a \"data\", \"path\", or \"url\" field.")
+        if data is not None:
+            content = base64.b64decode(data)
+        elif path is not None:
+            with open(path, "rb") as f:
+                content = f.read()
+        else:
+            # Don't download anything, just remember where the file came from
+            content = url.encode("utf-8")
+        if filename in self.media and not deleteExisting:
+            stem, dot, ext = filename.rpartition(".")
+            filename = f"{stem}_{self._new_id()}{dot}{ext}" if dot else f"{filename}_{self._new_id()}"
+        self.media[filename] = content
+        return filename
+
+    def action_retrieve_media_file(self, filename):
+        if filename not in self.media:
+            return False
+        return base64.b64encode(self.media[filename]).decode("ascii")
+
+    def action_get_media_files_names(self, pattern="*"):
+        regex = re.compile("^" + ".*".join(map(re.escape, pattern.split("*"))) + "$")
+        return [name for name in self.media if regex.match(name)]
+
+
+class FakeAnkiConnectServer(ThreadingHTTPServer):
+    """Serve a FakeAnki over HTTP like AnkiConnect does
+
+    Args:
+        anki (FakeAnki): Collection to serve. Defaults to an empty one with a
+            "Default" deck.
+        latency (float): Seconds to wait before answering each request
+        port (int): Port to listen on. Defaults to any free port.
+
+    `num_requests` counts the HTTP requests served and `actions` counts each
+    action, including the actions inside `multi` requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, anki=None, latency=0, host=DEFAULT_HOST, port=0):
+        super().__init__((host, port), _FakeAnkiConnectHandler)
+        self.anki = anki or FakeAnki()
+        self.latency = latency
+        self.num_requests = 0
+        self.actions = Counter()
+        self._count_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def respond(self, request):
+        "Return the response to a decoded AnkiConnect request"
+        action = request.get("action")
+        with self._count_lock:
+            self.num_requests += 1
+            self.actions[action] += 1
+            if action == "multi":
+                self.actions.update(a.get("action") for a in request.get("params", {}).get("actions", []))
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            return {"result": self.anki.handle(action, request.get("params", {})), "error": None}
+        except Exception as e:
+            return {"result": None, "error": str(e)}
+
+
+class _FakeAnkiConnectHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            request = json.loads(data) if data else {}
+        except ValueError:
+            request = {}
+        body = json.dumps(self.server.respond(request)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
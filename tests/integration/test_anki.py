@@ -1,58 +1,37 @@
 import unittest
-from ankify_roam import anki, roam, default_models
+from ankify_roam import anki, roam
 from ankify_roam.ankifiers import RoamGraphAnkifier
 from ankify_roam.default_models import ROAM_BASIC, ROAM_CLOZE, add_default_models
-import subprocess
-import os
-import psutil
+from tests.fake_anki import FakeAnki, FakeAnkiConnectServer
 import json
 import logging
 
 
-class AnkiAppTest:
-    @staticmethod
-    def get_process():
-        # source: https://psutil.readthedocs.io/en/latest/#find-process-by-name
-        for p in psutil.process_iter(['name']):
-            if p.info['name'] in ["Anki", "AnkiMac"]:
-                return p
-
-    @classmethod
-    def is_open(cls):
-        if cls.get_process():
-            return True
-        return False
-
-    @classmethod
-    def close(cls):
-        process = cls.get_process()
-        if process:
-            process.kill()
-        while cls.is_open():
-            pass
-
-    @classmethod
-    def open(cls):
-        if not cls.is_open():
-            subprocess.call(["open", "/Applications/Anki.app/"])
-        while not anki.connection_open():
-            pass
-        anki.load_profile("test")
-
-    @classmethod
-    def setup(cls):
-        args = util.get_default_args(RoamGraphAnkifier.__init__)
-        if args["deck"] not in anki.get_deck_names():
-            anki.create_deck(args["deck"])
-        for model in [ROAM_BASIC, ROAM_CLOZE]:
-            if not model['modelName'] in anki.get_model_names():
-                anki.create_model(model)
-
-
-class TestRoamGraphAnkifier(unittest.TestCase):
+class FakeAnkiTest(unittest.TestCase):
+    "Runs each test against a new FakeAnkiConnectServer with a 'test' profile"
+    def setUp(self):
+        self.server = FakeAnkiConnectServer(FakeAnki(profiles=["test"])).start()
+        self.addCleanup(self.server.stop)
+        default_client = anki.get_client()
+        self.addCleanup(lambda: anki.configure(default_client.host, default_client.port))
+        anki.configure(self.server.host, self.server.port)
+        # Note types which come with Anki
+        anki.create_model({
+            "modelName": "Basic",
+            "inOrderFields": ["Front", "Back"],
+            "cardTemplates": [{"Name": "Card 1", "Front": "{{Front}}", "Back": "{{Back}}"}]
+        })
+        anki.create_model({
+            "modelName": "Cloze",
+            "inOrderFields": ["Text", "Back Extra"],
+            "cardTemplates": [{"Name": "Cloze", "Front": "{{cloze:Text}}", "Back": "{{cloze:Text}}"}],
+            "isCloze": True
+        })
+
+
+class TestRoamGraphAnkifier(FakeAnkiTest):
     def setUp(self):
-        if not AnkiAppTest.is_open():
-            AnkiAppTest.open()
+        super().setUp()
         self.profile = "test"
         self.deck = "Default"
         if not anki.load_profile(self.profile):
@@ -70,24 +49,25 @@ class TestRoamGraphAnkifier(unittest.TestCase):
             pages = json.load(f)
         roam_graph = roam.RoamGraph(pages)
         ankifier = RoamGraphAnkifier(deck=self.deck)
+        ankifier.check_conn_and_params()
         with self.assertLogs() as ctx:
             ankifier.ankify(roam_graph)
         self.assertFalse(
             [r for r in ctx.records if r.levelno >= logging.WARNING])
+        self.assertTrue(self.server.anki.notes)
 
 
-class TestCheckConnAndParams(unittest.TestCase):
+class TestCheckConnAndParams(FakeAnkiTest):
     def test_no_anki_conn(self):
-        if AnkiAppTest.is_open():
-            AnkiAppTest.close()
+        self.server.stop()
+        # Drop the keep-alive connection, which the stopped server still answers on
+        anki.get_client().close()
         ankifier = RoamGraphAnkifier()
         with self.assertRaises(ValueError) as cm:
             ankifier.check_conn_and_params()
         self.assertEqual("Couldn't connect to Anki.", str(cm.exception))
 
     def test_bad_deck(self):
-        if not AnkiAppTest.is_open():
-            AnkiAppTest.open()
         ankifier = RoamGraphAnkifier(deck="not a deck")
         with self.assertRaises(ValueError) as cm:
             ankifier.check_conn_and_params()
@@ -96,8 +76,6 @@ class TestCheckConnAndParams(unittest.TestCase):
             str(cm.exception))
 
     def test_bad_note_basic(self):
-        if not AnkiAppTest.is_open():
-            AnkiAppTest.open()
         ankifier = RoamGraphAnkifier(
             note_basic="not a model", note_cloze="Cloze")
         with self.assertRaises(ValueError) as cm:
@@ -107,8 +85,6 @@ class TestCheckConnAndParams(unittest.TestCase):
             str(cm.exception))
 
     def test_bad_note_cloze(self):
-        if not AnkiAppTest.is_open():
-            AnkiAppTest.open()
         ankifier = RoamGraphAnkifier(
             note_basic="Basic", note_cloze="not a model")
         with self.assertRaises(ValueError) as cm:
@@ -118,8 +94,6 @@ class TestCheckConnAndParams(unittest.TestCase):
             str(cm.exception))
 
     def test_missing_uid_field(self):
-        if not AnkiAppTest.is_open():
-            AnkiAppTest.open()
         ankifier = RoamGraphAnkifier(note_basic="Basic", note_cloze="Cloze")
         with self.assertRaises(ValueError) as cm:
             ankifier.check_conn_and_params()
@@ -128,10 +102,9 @@ class TestCheckConnAndParams(unittest.TestCase):
             str(cm.exception))
 
 
-class TestAnki(unittest.TestCase):
+class TestAnki(FakeAnkiTest):
     def setUp(self):
-        if not AnkiAppTest.is_open():
-            AnkiAppTest.open()
+        super().setUp()
         self.profile = "test"
         self.deck = "test"
         if not anki.load_profile(self.profile):
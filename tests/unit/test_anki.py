@@ -0,0 +1,467 @@
+import unittest
+import json
+import asyncio
+import socket
+import threading
+import time
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ankify_roam import anki
+from ankify_roam.default_models import add_default_models
+from tests.fake_anki import FakeAnkiConnectServer
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    "Answers every request with its action and counts connections"
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    close_connection_after_response = False
+
+    def setup(self):
+        super().setup()
+        self.server.num_connections += 1
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        body = json.dumps(self.respond(request)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection_after_response:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond(self, request):
+        action = request.get("action")
+        if action == "multi":
+            return {"result": [self.respond(a) for a in request["params"]["actions"]], "error": None}
+        if action == "addNote":
+            return {"result": None, "error": "cannot create note because it is a duplicate"}
+        if action == "modelFieldNames":
+            return {"result": None, "error": "model was not found: " + request["params"]["modelName"]}
+        if action == "findNotes" and request["params"]["query"].startswith('"note:'):
+            return {"result": [3, 1, 2], "error": None}
+        if action == "notesInfo":
+            uids = {1: "abcdefghi", 2: "abcdefghi", 3: "jklmnopqr"}
+            return {"result": [
+                {"noteId": i, "modelName": "Basic", "tags": [], "cards": [i * 10],
+                 "fields": {"Front": {"value": "front", "order": 0}, "uid": {"value": uids.get(i, ""), "order": 1}}}
+                if i < 100 else {} for i in request["params"]["notes"]], "error": None}
+        return {"result": action, "error": None}
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAnkiConnectClient(unittest.TestCase):
+    def start_server(self, handler=EchoHandler):
+        server = ThreadingHTTPServer(("localhost", 0), handler)
+        server.num_connections = 0
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_reuses_connection(self):
+        server = self.start_server()
+        client = anki.AnkiConnectClient(*server.server_address[:2])
+        self.addCleanup(client.close)
+        for _ in range(5):
+            self.assertEqual(client.invoke("deckNames"), "deckNames")
+        self.assertEqual(server.num_connections, 1)
+
+    def test_reconnects_when_server_closes(self):
+        class ClosingHandler(EchoHandler):
+            close_connection_after_response = True
+        server = self.start_server(ClosingHandler)
+        client = anki.AnkiConnectClient(*server.server_address[:2])
+        self.addCleanup(client.close)
+        for _ in range(3):
+            self.assertEqual(client.invoke("deckNames"), "deckNames")
+        self.assertEqual(server.num_connections, 3)
+
+    def test_connection_refused(self):
+        server = self.start_server()
+        host, port = server.server_address[:2]
+        server.shutdown()
+        server.server_close()
+        client = anki.AnkiConnectClient(host, port, backoff=0)
+        self.assertFalse(client.connection_open())
+        with self.assertRaises(urllib.error.URLError):
+            client.invoke("deckNames")
+
+    def test_configure(self):
+        server = self.start_server()
+        default_client = anki.get_client()
+        self.addCleanup(lambda: anki.configure(default_client.host, default_client.port))
+        anki.configure(*server.server_address[:2])
+        self.assertTrue(anki.connection_open())
+        self.assertEqual(anki.get_deck_names(), "deckNames")
+
+    def test_get_notes_by_uid(self):
+        server = self.start_server()
+        default_client = anki.get_client()
+        self.addCleanup(lambda: anki.configure(default_client.host, default_client.port))
+        anki.configure(*server.server_address[:2])
+        notes = anki.get_notes_by_uid(["Basic", 'Cloze "quoted"'])
+        self.assertEqual(sorted(notes), ["abcdefghi", "jklmnopqr"])
+        # The oldest note is kept when uids are duplicated
+        self.assertEqual(notes["abcdefghi"]["noteId"], 1)
+        self.assertEqual(notes["abcdefghi"]["cards"], [10])
+        self.assertEqual(notes["jklmnopqr"]["fields"], {"Front": "front", "uid": "jklmnopqr"})
+
+    def test_retries_server_errors(self):
+        class FlakyHandler(EchoHandler):
+            "Fails the first two requests with a 503"
+            def do_POST(self):
+                self.server.num_requests += 1
+                if self.server.num_requests > 2:
+                    return super().do_POST()
+                self.rfile.read(int(self.headers["Content-Length"]))
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+        server = self.start_server(FlakyHandler)
+        server.num_requests = 0
+        client = anki.AnkiConnectClient(*server.server_address[:2], backoff=0)
+        self.addCleanup(client.close)
+        self.assertEqual(client.invoke("deckNames"), "deckNames")
+        self.assertEqual((client.stats["requests"], client.stats["retries"], client.stats["failed"]), (3, 2, 0))
+
+        # Actions which change Anki may have been carried out, so aren't retried
+        server.num_requests = 0
+        self.assertRaises(urllib.error.URLError, client.invoke, "multi", actions=[
+            anki._create_request_dict("findNotes", query="uid:abcdefghi"), 
+            anki._create_request_dict("addNote", note={})])
+        self.assertEqual((client.stats["requests"], client.stats["retries"], client.stats["failed"]), (4, 2, 1))
+
+    def test_retries_refused_connections(self):
+        server = self.start_server()
+        host, port = server.server_address[:2]
+        server.shutdown()
+        server.server_close()
+        client = anki.AnkiConnectClient(host, port, retries=2, backoff=0)
+        # Nothing was sent, so even actions which change Anki are retried
+        self.assertRaises(urllib.error.URLError, client.invoke, "addNotes", notes=[])
+        self.assertEqual((client.stats["requests"], client.stats["retries"], client.stats["failed"]), (3, 2, 1))
+
+    def test_circuit_breaker(self):
+        server = self.start_server()
+        host, port = server.server_address[:2]
+        server.shutdown()
+        server.server_close()
+        breaker = anki.CircuitBreaker(threshold=2, cooldown=0.05, max_pause=0.2)
+        client = anki.AnkiConnectClient(host, port, retries=1, backoff=0, breaker=breaker)
+        self.assertRaises(urllib.error.URLError, client.invoke, "deckNames")
+        self.assertTrue(breaker.is_open)
+        # Requests wait for the cooldown while the breaker is open
+        start = time.monotonic()
+        self.assertRaises(urllib.error.URLError, client.invoke, "deckNames")
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertGreater(client.stats["paused_seconds"], 0)
+        # Then fail straight away once it has been open for too long
+        time.sleep(0.2)
+        breaker.record_failure()
+        failed = client.stats["failed"]
+        self.assertRaises(anki.CircuitOpenError, client.invoke, "deckNames")
+        self.assertEqual(breaker.num_opened, 1)
+        self.assertEqual(client.stats["failed"], failed + 1)
+
+    def test_circuit_breaker_closes(self):
+        breaker = anki.CircuitBreaker(threshold=1, cooldown=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertEqual(breaker.wait_time(), 0)
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+
+
+class TestAsyncAnkiConnectClient(unittest.TestCase):
+    start_server = TestAnkiConnectClient.start_server
+
+    def run_client(self, server, coro_func, **kwargs):
+        async def run():
+            client = anki.AsyncAnkiConnectClient(*server.server_address[:2], **kwargs)
+            try:
+                return await coro_func(client)
+            finally:
+                await client.close()
+        return asyncio.run(run())
+
+    def test_reuses_connection(self):
+        server = self.start_server()
+        async def invoke_many(client):
+            return await asyncio.gather(*(client.invoke("deckNames") for _ in range(10)))
+        res = self.run_client(server, invoke_many, max_in_flight=2)
+        self.assertEqual(res, ["deckNames"] * 10)
+        self.assertLessEqual(server.num_connections, 2)
+
+    def test_reconnects_when_server_closes(self):
+        class ClosingHandler(EchoHandler):
+            close_connection_after_response = True
+        server = self.start_server(ClosingHandler)
+        async def invoke_three(client):
+            return [await client.invoke("deckNames") for _ in range(3)]
+        self.assertEqual(self.run_client(server, invoke_three), ["deckNames"] * 3)
+        self.assertEqual(server.num_connections, 3)
+
+    def test_connection_refused(self):
+        server = self.start_server()
+        server.shutdown()
+        server.server_close()
+        self.assertFalse(self.run_client(server, lambda client: client.connection_open()))
+        with self.assertRaises(urllib.error.URLError):
+            self.run_client(server, lambda client: client.invoke("deckNames"), backoff=0)
+
+    def test_send_batch(self):
+        server = self.start_server()
+        batch = anki.ActionBatch(max_bytes=100)
+        actions = [batch.add("deckNames"), batch.add("addNote", note={}), batch.add("modelNames")]
+        self.run_client(server, lambda client: client.send_batch(batch))
+        self.assertEqual(actions[0].result(), "deckNames")
+        self.assertRaises(anki.DuplicateError, actions[1].result)
+        self.assertEqual(actions[2].result(), "modelNames")
+
+
+class TestActionBatch(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("localhost", 0), EchoHandler)
+        self.server.num_connections = 0
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+        self.client = anki.AnkiConnectClient(*self.server.server_address[:2])
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_results(self):
+        batch = anki.ActionBatch(self.client)
+        a = batch.add("deckNames")
+        b = batch.add("addNote", note={})
+        c = batch.add("modelFieldNames", modelName="missing")
+        d = batch.add("findNotes", query="uid:abcdefghi")
+        self.assertEqual(len(batch), 4)
+        batch.send()
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(a.result(), "deckNames")
+        self.assertEqual(d.result(), "findNotes")
+        self.assertRaises(anki.DuplicateError, b.result)
+        self.assertRaises(anki.ModelNotFoundError, c.result)
+
+    def test_not_sent(self):
+        batch = anki.ActionBatch(self.client)
+        self.assertRaises(ValueError, batch.add("deckNames").result)
+        self.assertEqual(batch.send()[0].result(), "deckNames")
+        self.assertEqual(batch.send(), [])
+
+    def test_request_failed(self):
+        client = anki.AnkiConnectClient(*self.server.server_address[:2], backoff=0)
+        self.server.shutdown()
+        self.server.server_close()
+        batch = anki.ActionBatch(client)
+        actions = [batch.add("deckNames"), batch.add("modelNames")]
+        batch.send()
+        for action in actions:
+            self.assertRaises(urllib.error.URLError, action.result)
+
+
+class BulkHandler(EchoHandler):
+    "Adds notes unless their uid starts with 'dup', failing the whole addNotes request like newer AnkiConnect"
+    def respond(self, request):
+        action, params = request.get("action"), request.get("params", {})
+        self.server.actions.append(action)
+        if action == "addNotes":
+            if any(n["fields"]["uid"].startswith("dup") for n in params["notes"]):
+                return {"result": None, "error": "['cannot create note because it is a duplicate']"}
+            return {"result": list(range(len(params["notes"]))), "error": None}
+        if action == "addNote" and not params["note"]["fields"]["uid"].startswith("dup"):
+            return {"result": 1, "error": None}
+        if action == "findNotes":
+            return {"result": [], "error": None}
+        if action == "areSuspended":
+            # Odd cards are suspended and cards over 100 don't exist
+            return {"result": [None if c > 100 else c % 2 == 1 for c in params["cards"]], "error": None}
+        return super().respond(request)
+
+
+class TestBulkUpload(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("localhost", 0), BulkHandler)
+        self.server.num_connections = 0
+        self.server.actions = []
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+        self.client = anki.AnkiConnectClient(*self.server.server_address[:2])
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_notes(self, uids, size=10):
+        return [{"modelName": "Basic", "fields": {"Front": "x" * size, "uid": uid}} for uid in uids]
+
+    def test_chunk_by_size(self):
+        items = ["a" * 10, "b" * 10, "c" * 100, "d"]
+        self.assertEqual([len(c) for c in anki._chunk_by_size(items, 30)], [2, 1, 1])
+        self.assertEqual([len(c) for c in anki._chunk_by_size(items, 1000, max_items=3)], [3, 1])
+        self.assertEqual(list(anki._chunk_by_size([], 30)), [])
+
+    def test_add_notes(self):
+        actions = anki.add_notes(self.make_notes(["a", "b", "c"]), client=self.client, batch_size=2)
+        self.assertEqual([a.result() for a in actions], [0, 1, 0])
+        self.assertEqual(self.server.actions, ["multi", "addNotes", "addNotes"])
+
+    def test_add_notes_splits_large_requests(self):
+        anki.add_notes(self.make_notes(["a", "b", "c"], size=1000), client=self.client, max_bytes=2500)
+        self.assertEqual(self.server.actions, ["multi", "addNotes", "multi", "addNotes"])
+
+    def test_add_notes_falls_back_to_one_by_one(self):
+        actions = anki.add_notes(self.make_notes(["a", "dup", "b"]), client=self.client)
+        self.assertEqual(actions[0].result(), 1)
+        self.assertRaises(anki.DuplicateError, actions[1].result)
+        self.assertEqual(actions[2].result(), 1)
+
+    def test_update_suspended(self):
+        suspended, unsuspended = anki.update_suspended([1, 2, 4, 101], [3, 6, 102], client=self.client)
+        self.assertEqual((suspended, unsuspended), ([2, 4], [3]))
+        self.assertEqual(self.server.actions, ["areSuspended", "multi", "suspend", "unsuspend"])
+
+    def test_update_suspended_no_changes(self):
+        self.assertEqual(anki.update_suspended([1], [2], client=self.client), ([], []))
+        self.assertEqual(self.server.actions, ["areSuspended"])
+
+    def test_update_notes_fields(self):
+        actions = anki.update_notes_fields([(1, {"Front": "a"}), (2, {"Front": "b"})], client=self.client)
+        self.assertEqual([a.result() for a in actions], ["updateNoteFields"] * 2)
+        self.assertEqual(self.server.actions, ["multi", "updateNoteFields", "updateNoteFields"])
+
+
+class TestSyncTags(unittest.TestCase):
+    def setUp(self):
+        class RecordingHandler(EchoHandler):
+            def respond(self, request):
+                self.server.requests.append(request)
+                return super().respond(request)
+        self.server = ThreadingHTTPServer(("localhost", 0), RecordingHandler)
+        self.server.num_connections = 0
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+        self.client = anki.AnkiConnectClient(*self.server.server_address[:2])
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_groups_notes_with_the_same_changes(self):
+        note_tags = {1: ["a", "b", "new"], 2: ["a", "b", "new"], 3: ["a"], 4: ["b"]}
+        current_tags = {1: ["a", "b"], 2: ["a", "b", "old"], 3: ["a"]}
+        actions = anki.sync_tags(note_tags, current_tags, client=self.client)
+        sent = [(a.action, a.params["notes"], a.params["tags"]) for a in actions]
+        self.assertEqual(sent, [
+            ("removeTags", [2], "old"),
+            ("addTags", [1, 2], "new"),
+            ("addTags", [4], "b"),
+        ])
+        # Note 4 wasn't in current_tags so its tags were looked up first
+        self.assertEqual(self.server.requests[0]["params"], {"notes": [4]})
+        self.assertEqual([r["action"] for r in self.server.requests].count("multi"), 1)
+
+    def test_deleted_notes(self):
+        # Note 404 was deleted, so notesInfo returns {} for it
+        actions = anki.sync_tags({4: ["a"], 404: ["a"]}, client=self.client)
+        sent = [(a.action, a.params["notes"], a.params["tags"]) for a in actions]
+        self.assertEqual(sent, [("addTags", [4], "a")])
+
+    def test_no_changes(self):
+        actions = anki.sync_tags({1: ["a"]}, {1: ["a"]}, client=self.client)
+        self.assertEqual(actions, [])
+        self.assertEqual(self.server.requests, [])
+
+
+class TestFakeAnkiConnectServer(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAnkiConnectServer().start()
+        self.addCleanup(self.server.stop)
+        default_client = anki.get_client()
+        self.addCleanup(lambda: anki.configure(default_client.host, default_client.port))
+        anki.configure(self.server.host, self.server.port)
+        add_default_models()
+
+    def make_note(self, uid, front="front"):
+        return {"deckName": "Default", "modelName": "Roam Basic", 
+                "fields": {"Front": front, "Back": "back", "uid": uid}, "tags": ["a"]}
+
+    def test_models(self):
+        self.assertEqual(anki.get_model_names(), ["Roam Basic", "Roam Cloze"])
+        self.assertTrue(anki.is_model_cloze("Roam Cloze"))
+        self.assertFalse(anki.is_model_cloze("Roam Basic"))
+        self.assertRaises(anki.ModelNotFoundError, anki.get_field_names, "missing")
+
+    def test_notes(self):
+        note_id = anki.add_note(self.make_note("abcdefghi"))
+        self.assertRaises(anki.DuplicateError, anki.add_note, self.make_note("jklmnopqr"))
+        self.assertEqual(anki.get_note_id(self.make_note("abcdefghi")), note_id)
+        anki.update_fields(note_id, {"Front": "changed"})
+        anki.update_tags(note_id, ["b"])
+        note = anki.get_note(note_id)
+        self.assertEqual(note["fields"]["Front"]["value"], "changed")
+        self.assertEqual(note["tags"], ["b"])
+        self.assertEqual(list(anki.get_notes_by_uid(["Roam Basic"])), ["abcdefghi"])
+
+    def test_bulk_upload_and_suspend(self):
+        actions = anki.add_notes([self.make_note("a", "1"), self.make_note("b", "1"), self.make_note("c", "2")])
+        self.assertIsInstance(actions[0].result(), int)
+        self.assertRaises(anki.DuplicateError, actions[1].result)
+        card_ids = anki.get_card_ids(self.make_note("c"))
+        self.assertEqual(anki.update_suspended(card_ids, []), (card_ids, []))
+        self.assertEqual(anki.update_suspended(card_ids, []), ([], []))
+
+    def test_media(self):
+        self.assertFalse(anki.found_media("img.png"))
+        anki.add_media({"filename": "img.png", "data": "aW1n"})
+        self.assertTrue(anki.found_media("img.png"))
+        self.assertEqual(anki.get_media_file_names("*.png"), ["img.png"])
+
+    def test_media_manifest(self):
+        anki.add_media({"filename": "img.png", "data": "aW1n"})
+        manifest = anki.MediaManifest()
+        self.assertIn("img.png", manifest)
+        self.assertNotIn("new.png", manifest)
+        manifest.add("new.png", b"new")
+        self.assertIn("new.png", manifest)
+        self.assertEqual(manifest.find(b"new"), "new.png")
+        self.assertIsNone(manifest.find(b"other"))
+        self.assertEqual(self.server.actions["getMediaFilesNames"], 1)
+
+    def test_media_manifest_not_listed(self):
+        anki.add_media({"filename": "img.png", "data": "aW1n"})
+        # Nothing is listening on the client's port, so the files can't be listed
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            port = sock.getsockname()[1]
+        client = anki.AnkiConnectClient("localhost", port, retries=0)
+        manifest = anki.MediaManifest(client)
+        with self.assertLogs("ankify_roam.anki", level="WARNING"):
+            self.assertIn("img.png", manifest)
+        # Each file is checked with retrieveMediaFile instead of listing them again
+        self.assertNotIn("new.png", manifest)
+        self.assertEqual(client.stats["requests"], 1)
+        self.assertEqual(self.server.actions["retrieveMediaFile"], 2)
+
+    def test_counts_requests(self):
+        self.server.num_requests = 0
+        self.server.actions.clear()
+        batch = anki.ActionBatch()
+        batch.add("deckNames")
+        batch.add("modelNames")
+        batch.send()
+        self.assertEqual(self.server.num_requests, 1)
+        self.assertEqual(self.server.actions, {"multi": 1, "deckNames": 1, "modelNames": 1})
+
+    def test_latency(self):
+        self.server.latency = 0.05
+        start = time.monotonic()
+        anki.get_deck_names()
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
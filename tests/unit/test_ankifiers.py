@@ -1,10 +1,16 @@
 import unittest
+import os
 import re
+import shutil
+import tempfile
 import json
 import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from ankify_roam import roam, anki
 from ankify_roam.default_models import ROAM_BASIC, ROAM_CLOZE, add_default_models
-from ankify_roam.ankifiers import BlockAnkifier
+from ankify_roam.ankifiers import BlockAnkifier, BlockOptions, RoamGraphAnkifier
+from tests.fake_anki import FakeAnkiConnectServer
 from ankify_roam.roam import Page, Block, BlockContent
 from ankify_roam import util
 from bs4 import BeautifulSoup
@@ -32,6 +38,38 @@ class TestBlockAnkifier(unittest.TestCase):
         block = Block.from_string("a block #[[ankify: deck='1-Daily']]")
         self.assertEqual(ankifier._get_option(block, 'deck'), "1-Daily")
 
+    def test_get_options(self):
+        roam_graph = roam.RoamGraph([{"title": "page", "children": [
+            {"string": "parent #[[ankify: deck=Parent]] #[[ankify: num-parents=all]]", "uid": "parent000", "children": [
+                {"string": "first #ankify #[[ankify: deck='Child']] #[[ankify: max-depth=None]]", "uid": "child0000"},
+                {"string": "second {c1:cloze} #ankify #[[ankify: suspend=True]]", "uid": "child0001"},
+            ]},
+        ]}])
+        ankifier = BlockAnkifier(max_depth=2)
+        first, second = roam_graph.query_by_uid("child0000"), roam_graph.query_by_uid("child0001")
+        self.assertEqual(ankifier.get_options(first), BlockOptions(
+            deck="Child", num_parents="all", max_depth=None))
+        self.assertEqual(ankifier.get_options(second), BlockOptions(
+            deck="Parent", num_parents="all", max_depth=2, suspend=True))
+        self.assertEqual(ankifier._get_note_type(second), "Roam Cloze")
+        # The parent's options are parsed once for both children
+        self.assertIs(ankifier._option_resolver.resolve(first.parent), ankifier._option_resolver.resolve(second.parent))
+
+    def test_get_options_from_attr(self):
+        roam_graph = roam.RoamGraph([{"title": "page", "children": [
+            {"string": "parent #[[ankify: deck=Parent]]", "uid": "parent000", "children": [
+                {"string": "question #ankify", "uid": "question0", "children": [
+                    {"string": "tags:: [[ankify: deck=Attr]] [[ankify: suspend=False]]", "uid": "attribute"},
+                ]},
+            ]},
+        ]}])
+        block = roam_graph.query_by_uid("question0")
+        # Tags from attributes come after the parents' tags
+        options = BlockAnkifier(tags_from_attr=True).get_options(block)
+        self.assertEqual((options.deck, options.suspend), ("Parent", False))
+        options = BlockAnkifier().get_options(block)
+        self.assertEqual((options.deck, options.suspend), ("Parent", None))
+
     def test_front_to_html(self):
         """
         - [[Page title]]
@@ -229,6 +267,49 @@ class TestBlockAnkifier(unittest.TestCase):
 
         self.assertEqual(actual_srcs, expected_srcs)
 
+    def test_download_imgs_media_manifest(self):
+        class ImageHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.server.paths.append(self.path)
+                body = b"image a" if self.path.endswith("a.png") else b"image b"
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        img_server = ThreadingHTTPServer(("localhost", 0), ImageHandler)
+        img_server.paths = []
+        threading.Thread(target=img_server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+        self.addCleanup(img_server.server_close)
+        self.addCleanup(img_server.shutdown)
+        url = "http://localhost:%d" % img_server.server_address[1]
+
+        anki_server = FakeAnkiConnectServer().start()
+        self.addCleanup(anki_server.stop)
+        anki_server.anki.media["stored.png"] = b"image stored"
+        default_client = anki.get_client()
+        self.addCleanup(lambda: anki.configure(default_client.host, default_client.port))
+        anki.configure(anki_server.host, anki_server.port)
+
+        ankifier = BlockAnkifier(note_basic="my basic", field_names={"my basic": ["Front", "Back"]}, download_imgs='once')
+        def ankify(string):
+            note = ankifier.ankify(Block(content=BlockContent.from_string(string), children=[], parent=Page("page")))
+            srcs = [img['src'] for img in BeautifulSoup(note['fields']['Front'], 'html.parser').find_all("img")]
+            return srcs, [image["filename"] for image in note.get("images", [])]
+
+        # a.png and b.png are downloaded, and copy.png has the same content as b.png
+        srcs, stored = ankify(f"![]({url}/stored.png) ![]({url}/a.png) ![]({url}/b.png) ![]({url}/copy.png)")
+        self.assertEqual(srcs, ["stored.png", "a.png", "b.png", "b.png"])
+        self.assertEqual(stored, ["a.png", "b.png"])
+        self.assertEqual(img_server.paths, ["/a.png", "/b.png", "/copy.png"])
+        # Images from earlier blocks aren't downloaded or stored again
+        srcs, stored = ankify(f"![]({url}/a.png) ![]({url}/copy.png)")
+        self.assertEqual((srcs, stored), (["a.png", "b.png"], []))
+        self.assertEqual(len(img_server.paths), 3)
+        self.assertEqual(anki_server.actions["getMediaFilesNames"], 1)
+        self.assertEqual(anki_server.actions["retrieveMediaFile"], 0)
+
     def test_ankify_root(self):
         block = Block(
             content=BlockContent.from_string("question"),
@@ -277,6 +358,216 @@ class TestBlockAnkifier(unittest.TestCase):
         self.assertEqual(actual, expected)
 
 
+class TestRoamGraphAnkifier(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAnkiConnectServer().start()
+        self.addCleanup(self.server.stop)
+        default_client = anki.get_client()
+        self.addCleanup(lambda: anki.configure(default_client.host, default_client.port))
+        anki.configure(self.server.host, self.server.port)
+        add_default_models()
+
+    def ankify(self, **kwargs):
+        roam_graph = roam.RoamGraph.from_path("tests/export-pages.json")
+        with self.assertLogs("ankify_roam.ankifiers", level="INFO") as ctx:
+            RoamGraphAnkifier(**kwargs).ankify(roam_graph)
+        return [r.getMessage() for r in ctx.records if r.getMessage().startswith("Results")][0]
+
+    def num_blocks_to_ankify(self):
+        roam_graph = roam.RoamGraph.from_path("tests/export-pages.json")
+        return len(roam_graph.query_by_tag("ankify", inherit=False, exclude="dont-ankify"))
+
+    def test_ankify(self):
+        n = self.num_blocks_to_ankify()
+        self.assertEqual(self.ankify(), f"Results: {n} notes added, 0 updated, 0 unchanged, 0 failed")
+        self.assertEqual(len(self.server.anki.notes), n)
+        self.assertEqual(self.ankify(), f"Results: 0 notes added, 0 updated, {n} unchanged, 0 failed")
+        suspended = [c for c in self.server.anki.cards.values() if c["suspended"]]
+        self.assertEqual(len(suspended), 1)
+
+    def test_ankify_async(self):
+        n = self.num_blocks_to_ankify()
+        self.assertEqual(self.ankify(batch_size=3, max_in_flight=2), f"Results: {n} notes added, 0 updated, 0 unchanged, 0 failed")
+        self.assertEqual(self.ankify(batch_size=3, max_in_flight=2), f"Results: 0 notes added, 0 updated, {n} unchanged, 0 failed")
+
+    def test_ankify_pipeline_stats(self):
+        roam_graph = roam.RoamGraph.from_path("tests/export-pages.json")
+        with self.assertLogs("ankify_roam.ankifiers", level="INFO") as ctx:
+            RoamGraphAnkifier(batch_size=4).ankify(roam_graph)
+        n = self.num_blocks_to_ankify()
+        message = ctx.records[-1].getMessage()
+        self.assertTrue(message.startswith(f"Pipeline: select {n} at "))
+        for stage in ["convert", "diff", "upload"]:
+            self.assertRegex(message, f"{stage} {n} at [0-9]+/s \\(queue max [0-9]+, mean [0-9.]+\\)")
+
+    def test_ankify_jobs(self):
+        n = self.num_blocks_to_ankify()
+        self.assertEqual(self.ankify(jobs=3, batch_size=4), f"Results: {n} notes added, 0 updated, 0 unchanged, 0 failed")
+        uids = [note["fields"]["uid"] for note in self.server.anki.notes.values()]
+        # Notes are added in block order, like when converting in one process
+        self.server.anki.notes.clear()
+        self.ankify(batch_size=4)
+        self.assertEqual([note["fields"]["uid"] for note in self.server.anki.notes.values()], uids)
+
+    def test_ankify_jobs_media_manifest(self):
+        pages = [{"title": "page", "children": [
+            {"string": f"![](http://localhost/img{i}.png) #ankify", "uid": str(i) * 9}
+            for i in range(4)]}]
+        for i in range(4):
+            self.server.anki.media[f"img{i}.png"] = b"image"
+        with self.assertLogs("ankify_roam.ankifiers", level="INFO") as ctx:
+            RoamGraphAnkifier(jobs=2, batch_size=1, download_imgs="once").ankify(roam.RoamGraph(pages))
+        self.assertIn("Results: 4 notes added, 0 updated, 0 unchanged, 0 failed", [r.getMessage() for r in ctx.records])
+        # The media in Anki is listed before the workers start, instead of by each worker
+        self.assertEqual(self.server.actions["getMediaFilesNames"], 1)
+
+    def test_ankify_jobs_conversion_errors(self):
+        pages = [{"title": "page", "children": [
+            {"string": "first #ankify", "uid": "aaaaaaaaa"},
+            {"string": "missing note type #ankify #[[ankify:note=Missing]]", "uid": "bbbbbbbbb"},
+            {"string": "last #ankify", "uid": "ccccccccc"},
+        ]}]
+        with self.assertLogs("ankify_roam.ankifiers", level="INFO") as ctx:
+            RoamGraphAnkifier(jobs=2, batch_size=1).ankify(roam.RoamGraph(pages))
+        errors = [r.getMessage() for r in ctx.records if r.levelno == logging.ERROR]
+        self.assertEqual(len(errors), 1)
+        self.assertIn("bbbbbbbbb", errors[0])
+        self.assertIn("ModelNotFoundError", errors[0])
+        self.assertIn("Results: 2 notes added, 0 updated, 0 unchanged, 1 failed", [r.getMessage() for r in ctx.records])
+
+    def test_ankify_sync_state(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        sync_state = os.path.join(state_dir, "sync_state.json")
+        pages = [{"title": "page", "children": [
+            {"string": "question ((ccccccccc)) #ankify", "uid": "aaaaaaaaa", "children": [
+                {"string": "answer", "uid": "aaaaaaaab"}]},
+            {"string": "other question #ankify", "uid": "bbbbbbbbb", "children": [
+                {"string": "other answer", "uid": "bbbbbbbbc"}]},
+            {"string": "referenced", "uid": "ccccccccc"},
+        ]}]
+        def ankify(pages, **kwargs):
+            with self.assertLogs("ankify_roam.ankifiers", level="INFO") as ctx:
+                RoamGraphAnkifier(sync_state=sync_state, **kwargs).ankify(roam.RoamGraph(pages))
+            messages = [r.getMessage() for r in ctx.records]
+            return [m for m in messages if m.startswith("Results")][0], messages[-1]
+
+        self.assertEqual(ankify(pages)[0], "Results: 2 notes added, 0 updated, 0 unchanged, 0 failed")
+        results, pipeline = ankify(pages)
+        self.assertEqual(results, "Results: 0 notes added, 0 updated, 2 unchanged, 0 failed")
+        self.assertIn("convert 0 at", pipeline)
+        # Changing a referenced block re-renders the block referencing it
+        pages[0]["children"][2]["string"] = "changed"
+        results, pipeline = ankify(pages)
+        self.assertEqual(results, "Results: 0 notes added, 1 updated, 1 unchanged, 0 failed")
+        self.assertIn("convert 1 at", pipeline)
+        # Notes deleted in Anki are added again
+        self.server.anki.notes.clear()
+        self.assertEqual(ankify(pages)[0], "Results: 2 notes added, 0 updated, 0 unchanged, 0 failed")
+        results, pipeline = ankify(pages, full=True)
+        self.assertEqual(results, "Results: 0 notes added, 0 updated, 2 unchanged, 0 failed")
+        self.assertIn("convert 2 at", pipeline)
+        # Changing the settings syncs every block
+        self.assertIn("convert 2 at", ankify(pages, num_parents=1)[1])
+
+    def test_ankify_sync_state_unchanged_notes(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        sync_state = os.path.join(state_dir, "sync_state.json")
+        n = self.num_blocks_to_ankify()
+        self.ankify(sync_state=sync_state)
+        # Edit times aren't on the notes, so blocks with only new edit times 
+        # are converted again but their notes are unchanged
+        with open("tests/export-pages.json") as f:
+            pages = json.load(f)
+        blocks = list(pages)
+        while blocks:
+            block = blocks.pop()
+            block["edit-time"] = block.get("edit-time", 0) + 1
+            blocks.extend(block.get("children", []))
+        self.server.actions.clear()
+        with self.assertLogs("ankify_roam.ankifiers", level="INFO") as ctx:
+            RoamGraphAnkifier(sync_state=sync_state).ankify(roam.RoamGraph(pages))
+        self.assertIn(f"Results: 0 notes added, 0 updated, {n} unchanged, 0 failed", [r.getMessage() for r in ctx.records])
+        self.assertIn(f"convert {n} at", ctx.records[-1].getMessage())
+        # Only the note ids are fetched, with one findNotes
+        self.assertEqual(self.server.actions["notesInfo"], 0)
+        self.assertEqual(self.server.actions["findNotes"], 1)
+        self.assertEqual(self.server.actions["updateNoteFields"], 0)
+        # Notes changed in Anki are only updated with --full
+        note = next(iter(self.server.anki.notes.values()))
+        first_field = next(iter(note["fields"]))
+        note["fields"][first_field] = "changed in Anki"
+        self.assertIn(" 0 updated,", self.ankify(sync_state=sync_state))
+        self.assertIn(" 1 updated,", self.ankify(sync_state=sync_state, full=True))
+        self.assertNotEqual(note["fields"][first_field], "changed in Anki")
+
+    def test_ankify_note_errors(self):
+        self.server.anki.action_create_model("No Uid", ["Front", "Back"], 
+            [{"Name": "Card 1", "Front": "{{Front}}", "Back": "{{Back}}"}])
+        pages = [{"title": "page", "children": [
+            {"string": "first #ankify", "uid": "aaaaaaaaa"},
+            {"string": "no uid field #ankify #[[ankify:note=No Uid]]", "uid": "bbbbbbbbb"},
+            {"string": "deleted #ankify", "uid": "ccccccccc"},
+            {"string": "last #ankify", "uid": "ddddddddd"},
+        ]}]
+        # The note is found but deleted before its info is fetched
+        find_notes = self.server.anki.action_find_notes
+        self.server.anki.action_find_notes = lambda query: [123] if query == "uid:ccccccccc" else find_notes(query)
+        with self.assertLogs("ankify_roam.ankifiers", level="INFO") as ctx:
+            RoamGraphAnkifier(batch_size=2).ankify(roam.RoamGraph(pages))
+        errors = [r for r in ctx.records if r.levelno == logging.ERROR]
+        self.assertEqual(len(errors), 2)
+        self.assertIn("bbbbbbbbb", errors[0].getMessage())
+        self.assertIs(errors[0].exc_info[0], KeyError)
+        self.assertIn("ccccccccc", errors[1].getMessage())
+        self.assertIn("Results: 2 notes added, 0 updated, 0 unchanged, 2 failed", [r.getMessage() for r in ctx.records])
+
+    def test_ankify_count_failed_notes_once(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        sync_state = os.path.join(state_dir, "sync_state.json")
+        pages = [{"title": "page", "children": [
+            {"string": "question #ankify #[[ankify: suspend=False]]", "uid": "aaaaaaaaa"}]}]
+        def ankify():
+            with self.assertLogs("ankify_roam.ankifiers", level="INFO") as ctx:
+                RoamGraphAnkifier(sync_state=sync_state).ankify(roam.RoamGraph(pages))
+            return [r.getMessage() for r in ctx.records if r.getMessage().startswith("Results")][0]
+
+        self.assertEqual(ankify(), "Results: 1 notes added, 0 updated, 0 unchanged, 0 failed")
+        # The note is updated but its cards can't be found
+        def find_cards(query):
+            raise Exception("findCards failed")
+        self.server.anki.action_find_cards = find_cards
+        pages[0]["children"][0]["string"] = "changed question #ankify #[[ankify: suspend=False]]"
+        self.assertEqual(ankify(), "Results: 0 notes added, 0 updated, 0 unchanged, 1 failed")
+        # So it isn't recorded as synced
+        del self.server.anki.action_find_cards
+        self.assertEqual(ankify(), "Results: 0 notes added, 1 updated, 0 unchanged, 0 failed")
+
+    def test_ankify_count_failed_new_notes_once(self):
+        pages = [{"title": "page", "children": [
+            {"string": "question #ankify #[[ankify: suspend=True]]", "uid": "aaaaaaaaa"},
+            {"string": "other question #ankify", "uid": "bbbbbbbbb"}]}]
+        # The notes are added with addNotes, but the new note's cards can't be 
+        # found to suspend them
+        def find_cards(query):
+            raise Exception("findCards failed")
+        self.server.anki.action_find_cards = find_cards
+        with self.assertLogs("ankify_roam.ankifiers", level="INFO") as ctx:
+            RoamGraphAnkifier().ankify(roam.RoamGraph(pages))
+        self.assertIn("Results: 1 notes added, 0 updated, 0 unchanged, 1 failed", [r.getMessage() for r in ctx.records])
+        self.assertEqual(self.server.actions["addNotes"], 1)
+
+    def test_update_changed_notes(self):
+        self.ankify()
+        note = next(iter(self.server.anki.notes.values()))
+        first_field = next(iter(note["fields"]))
+        note["fields"][first_field] = "changed in Anki"
+        self.assertIn(" 1 updated,", self.ankify())
+        self.assertNotEqual(note["fields"][first_field], "changed in Anki")
+
+
 def remove_html_whitespace(html_string):
     html_string = re.sub(">\s*\n?\s*<", "><", html_string)
     html_string = re.sub("^\s*\n?\s*", "", html_string)
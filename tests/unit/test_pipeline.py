@@ -0,0 +1,54 @@
+import unittest
+import threading
+from ankify_roam.pipeline import Pipeline
+
+
+class TestPipeline(unittest.TestCase):
+    def test_run(self):
+        results = []
+        pipeline = Pipeline(maxsize=1)
+        pipeline.add_stage("numbers", lambda: ([i, i + 1] for i in range(0, 10, 2)), size=len)
+        pipeline.add_stage("double", lambda batches: ([n * 2 for n in batch] for batch in batches), size=len)
+        pipeline.add_stage("collect", lambda batches: results.extend(batches), size=len)
+        stats = pipeline.run()
+        self.assertEqual(results, [[0, 2], [4, 6], [8, 10], [12, 14], [16, 18]])
+        self.assertEqual([s.name for s in stats], ["numbers", "double", "collect"])
+        self.assertEqual([s.items for s in stats], [10, 10, 10])
+        self.assertTrue(all(1 <= s.max_queue_depth <= 1 for s in stats[1:]))
+        self.assertIn("double 10 at", str(stats[1]))
+        self.assertIn("(queue max 1", str(stats[1]))
+
+    def test_queues_are_bounded(self):
+        produced = []
+        consume = threading.Event()
+        def produce():
+            for i in range(10):
+                produced.append(i)
+                yield i
+        def wait_then_consume(items):
+            consume.wait()
+            return list(items)
+        pipeline = Pipeline(maxsize=2)
+        pipeline.add_stage("produce", produce)
+        pipeline.add_stage("consume", wait_then_consume)
+        thread = threading.Thread(target=pipeline.run)
+        thread.start()
+        thread.join(0.3)
+        # Two items in the queue and one waiting to go in
+        self.assertEqual(len(produced), 3)
+        consume.set()
+        thread.join()
+        self.assertEqual(len(produced), 10)
+
+    def test_error_stops_other_stages(self):
+        def produce():
+            while True:
+                yield 1
+        def fail(items):
+            next(items)
+            raise ValueError("failed")
+        pipeline = Pipeline(maxsize=1)
+        pipeline.add_stage("produce", produce)
+        pipeline.add_stage("fail", fail)
+        with self.assertRaisesRegex(ValueError, "failed"):
+            pipeline.run()
@@ -1,5 +1,8 @@
 import unittest
+import os
 import json
+import tempfile
+from zipfile import ZipFile
 from ankify_roam.roam.containers import RoamGraph, Page, Block 
 from ankify_roam.roam.content import BlockContent
 
@@ -62,6 +65,94 @@ class TestRoamGraph(unittest.TestCase):
         b = set(["TODO","page","temp","test page for [[ankify_roam]]"])
         self.assertSetEqual(a,b)
 
+    def test_query_by_uid(self):
+        block = self.roam_db.query_by_uid("5xB8JO-xg")
+        self.assertEqual(block.to_string(), "some have children #tag ")
+        self.assertIsNone(self.roam_db.query_by_uid("not-a-uid"))
+
+        new_block = Block.from_string("new block", uid="newblock1")
+        self.roam_db.pages[0].children.append(new_block)
+        self.roam_db.index_blocks()
+        self.assertIs(self.roam_db.query_by_uid("newblock1"), new_block)
+
+    def test_block_ref_resolution(self):
+        block = self.roam_db.query_by_uid("L7EuhRiXa")
+        a = block.content[1].to_string(expand=True)
+        b = "some have children #tag "
+        self.assertEqual(a, b)
+
+
+    def test_query_by_tag(self):
+        a = [b.uid for b in self.roam_db.query_by_tag("temp")]
+        b = ["YlgtAqOYv", "5xB8JO-xg", "L7EuhRiXa"]
+        self.assertEqual(a, b)
+
+        a = [b.uid for b in self.roam_db.query_by_tag("temp", inherit=False)]
+        b = ["YlgtAqOYv", "L7EuhRiXa"]
+        self.assertEqual(a, b)
+
+        a = [b.uid for b in self.roam_db.query_by_tag("temp", exclude="TODO")]
+        b = ["L7EuhRiXa"]
+        self.assertEqual(a, b)
+
+        self.assertEqual(self.roam_db.query_by_tag("not a tag"), [])
+
+    def test_query_by_tag_matches_get_tags(self):
+        with open("tests/export-pages.json") as f:
+          roam_graph = RoamGraph(json.load(f))
+        for from_attr in [False, True]:
+            for tag in ["temp", "ankify", "TODO"]:
+                a = roam_graph.query_by_tag(tag, inherit=False, from_attr=from_attr)
+                b = roam_graph.query_many(lambda b: tag in b.get_tags(inherit=False, from_attr=from_attr))
+                self.assertEqual(a, b)
+                a = roam_graph.query_by_tag(tag, from_attr=from_attr)
+                b = roam_graph.query_many(lambda b: tag in b.get_tags(from_attr=from_attr))
+                self.assertEqual(a, b)
+
+    def test_query_by_tag_after_edit(self):
+        self.assertEqual(self.roam_db.query_by_tag("new tag"), [])
+        block = self.roam_db.query_by_uid("YlgtAqOYv")
+        block.content = BlockContent.from_string(block.to_string() + " #[[new tag]]")
+        self.assertEqual(self.roam_db.query_by_tag("new tag", inherit=False), [block])
+
+    def test_get_page(self):
+        page = self.roam_db.get_page("test page for [[ankify_roam]]")
+        self.assertEqual(page.title, "test page for [[ankify_roam]]")
+        self.assertIsNone(self.roam_db.get_page("Test Page For [[ankify_roam]]"))
+        a = self.roam_db.get_page("Test Page For [[ankify_roam]]", case_sensitive=False)
+        self.assertIs(a, page)
+
+    def test_add_page(self):
+        page = Page("new page", [Block.from_string("new block", uid="newblock1")])
+        self.roam_db.add_page(page)
+        self.assertIs(self.roam_db.get_page("new page"), page)
+        self.assertIs(self.roam_db.get_page("NEW PAGE", case_sensitive=False), page)
+        self.assertIs(self.roam_db.query_by_uid("newblock1").parent_page, page)
+
+        # Pages appended directly are picked up too
+        page = Page("another page", [])
+        self.roam_db.pages.append(page)
+        self.assertIs(self.roam_db.get_page("another page"), page)
+
+
+    def test_from_json(self):
+        a = RoamGraph.from_json("tests/export-pages.json", stream=True)
+        b = RoamGraph.from_json("tests/export-pages.json", stream=False)
+        self.assertEqual([p.title for p in a.pages], [p.title for p in b.pages])
+        self.assertEqual(sorted(a.blocks_by_uid), sorted(b.blocks_by_uid))
+        for uid, block in a.blocks_by_uid.items():
+            self.assertEqual(block.to_string(), b.blocks_by_uid[uid].to_string())
+
+    def test_from_zip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "Roam-Export-1.zip")
+            with ZipFile(path, "w") as zip_ref:
+                zip_ref.write("tests/export-pages.json", "export.json")
+            a = RoamGraph.from_path(tmpdir)
+        b = RoamGraph.from_json("tests/export-pages.json", stream=False)
+        self.assertEqual([p.title for p in a.pages], [p.title for p in b.pages])
+        self.assertEqual(sorted(a.blocks_by_uid), sorted(b.blocks_by_uid))
+
 
 class TestPage(unittest.TestCase):
     def test_num_descendants(self):
@@ -81,6 +172,87 @@ class TestBlock(unittest.TestCase):
         self.assertEqual(block.num_descendants(), 9)
 
 
+    def test_get_tags_cache(self):
+        parent = Block(BlockContent.from_string("#parent"))
+        child = Block(BlockContent.from_string("#child"), parent=parent)
+        self.assertEqual(child.get_tags(), ["child", "parent"])
+
+        start = Block.tag_cache_info()
+        self.assertEqual(child.get_tags(), ["child", "parent"])
+        self.assertEqual(Block.tag_cache_info()["hits"], start["hits"] + 1)
+
+        # Returned lists can be changed without changing the cache
+        child.get_tags().append("other")
+        self.assertEqual(child.get_tags(), ["child", "parent"])
+
+        parent.content = BlockContent.from_string("#new-parent")
+        self.assertEqual(child.get_tags(), ["child", "new-parent"])
+        child.parent = None
+        self.assertEqual(child.get_tags(), ["child"])
+
+        # Pages are tracked too
+        parent.children = [child]
+        page = Page("page", [parent])
+        page.propagate_parents()
+        self.assertEqual(child.get_tags(), ["child", "new-parent", "page"])
+        page.title = "renamed page"
+        self.assertEqual(child.get_tags(), ["child", "new-parent", "renamed page"])
+        page.children = [Block(BlockContent.from_string("tags:: #[[from attr]]"))]
+        self.assertEqual(page.get_tags(from_attr=True), ["renamed page", "from attr"])
+        self.assertEqual(parent.get_tags(from_attr=True), ["new-parent", "renamed page", "from attr"])
+
+
+    def test_parents(self):
+        with open("tests/export-pages.json") as f:
+          pages = json.load(f)
+        roam_graph = RoamGraph(pages)
+        block = roam_graph.query_by_uid("klGAc1Gi3")
+        child = block.children[0]
+        grandchild = child.children[0]
+        page = roam_graph.get_page("Geography")
+        self.assertEqual(grandchild.parents, [child, block, page])
+        self.assertEqual(grandchild.parent_blocks, [child, block])
+        self.assertIs(grandchild.parent_page, page)
+        self.assertEqual(grandchild.depth, 2)
+        self.assertEqual(block.depth, 0)
+
+        # Editing a block keeps the ancestors cached, moving one doesn't
+        parent_version = Block.parent_version
+        block.content = BlockContent.from_string("edited")
+        block.children = block.children
+        self.assertEqual(Block.parent_version, parent_version)
+        structure_version = Block.structure_version
+        child.parent = None
+        self.assertEqual(Block.structure_version, structure_version)
+
+        # Moving a block updates the ancestors of its children
+        self.assertEqual(grandchild.parents, [child])
+        self.assertEqual(grandchild.parent_blocks, [child])
+        self.assertIsNone(grandchild.parent_page)
+        self.assertEqual(grandchild.depth, 1)
+
+
+    def test_lazy_content(self):
+        block = Block.from_dict({"string": "some [[page]] #ankify", "uid": "abcdefghi"})
+        self.assertFalse(block.is_parsed())
+        self.assertEqual(block.string, "some [[page]] #ankify")
+        self.assertTrue(block.might_have_tag("ankify"))
+        self.assertFalse(block.might_have_tag("dont-ankify"))
+        self.assertFalse(block.is_parsed())
+        self.assertSetEqual(set(block.get_tags()), set(["page", "ankify"]))
+        self.assertTrue(block.is_parsed())
+
+    def test_query_by_tag_parses_tagged_blocks(self):
+        with open("tests/export-pages.json") as f:
+          roam_graph = RoamGraph(json.load(f))
+        self.assertFalse(any(b.is_parsed() for b in roam_graph.blocks_by_uid.values()))
+        blocks = roam_graph.query_by_tag("ankify", inherit=False)
+        parsed = [b for b in roam_graph.blocks_by_uid.values() if b.is_parsed()]
+        self.assertTrue(all(b.might_have_tag("ankify") for b in parsed))
+        self.assertLess(len(parsed), len(roam_graph.blocks_by_uid))
+        self.assertEqual(len(blocks), 16)
+
+
 class TestTagsFromAttribute(unittest.TestCase):
   def test_block(self):
     block = Block(
@@ -1,5 +1,6 @@
 import unittest 
 import logging
+import json
 from ankify_roam import anki, roam
 from ankify_roam.roam.containers import Block
 from ankify_roam.roam.content import * 
@@ -705,6 +706,32 @@ class TestPageRef(unittest.TestCase):
         b = ["[[page]]", "[[another]]"]
         self.assertSetEqual(set(a), set(b))
 
+    def test_extract_page_ref_spans(self):
+        a = PageRef.extract_page_ref_spans("[[a [[b]]]] and [[c]]")
+        b = ([(0, 11), (16, 21)], None)
+        self.assertEqual(a, b)
+
+        a = PageRef.extract_page_ref_spans("[[a]] then [[unclosed [[b]]")
+        b = ([(0, 5)], 11)
+        self.assertEqual(a, b)
+
+    def test_find_page_ref_end(self):
+        self.assertEqual(PageRef.find_page_ref_end("[[a [[b]]]] c", 0), 11)
+        self.assertEqual(PageRef.find_page_ref_end("[[a [[b]]]] c", 4), 9)
+        self.assertEqual(PageRef.find_page_ref_end("[[[a]]]", 0), 6)
+        self.assertIsNone(PageRef.find_page_ref_end("[[a [[b]]", 0))
+        self.assertIsNone(PageRef.find_page_ref_end("[[a]]", 0, 4))
+
+    def test_find_substring_locs(self):
+        a = PageRef.find_substring_locs("[[a [[b]]]] and [[c]]")
+        b = [(0, 11), (16, 21)]
+        self.assertEqual(a, b)
+
+        # Page refs seen earlier still match after an unclosed page ref
+        a = PageRef.find_substring_locs("[[c]] then [[unclosed [[c]] [[d]]")
+        b = [(0, 5), (22, 27)]
+        self.assertEqual(a, b)
+
 
 class TestPageTag(unittest.TestCase):
     def test_from_string(self):
@@ -953,6 +980,75 @@ class TestAttribute(unittest.TestCase):
         self.assertListEqual(a,b)
 
 
+class TestBlockContentTokenizer(unittest.TestCase):
+    def assertSameContent(self, a, b):
+        self.assertListEqual([type(o) for o in a], [type(o) for o in b])
+        self.assertListEqual([o.to_string() for o in a], [o.to_string() for o in b])
+        self.assertEqual(a.to_html(), b.to_html())
+
+    def test_matches_find_and_replace_on_export(self):
+        with open("tests/export-pages.json") as f:
+            pages = json.load(f)
+        strings = []
+        blocks = [b for p in pages for b in p.get("children", [])]
+        while blocks:
+            block = blocks.pop()
+            strings.append(block["string"])
+            blocks += block.get("children", [])
+        for string in strings:
+            with self.subTest(string=string):
+                a = BlockContent.from_string(string)
+                b = BlockContent.from_string(string, tokenize=False)
+                self.assertSameContent(a, b)
+
+    def test_priority(self):
+        strings = [
+            "[[page with #tag]]",
+            "{{query: {and: [[a]] [[b]]}}} {{embed: ((abcdefghi))}}",
+            "http://www.google.com/search#results and [alias](www.google.com)",
+            "[[unclosed [[page]] and [[page]]",
+            "[[page]] attribute:: value",
+            "`code with [[page]]` and {cloze with `code`}",
+            "{{[[query]]: {and: [[p]]}}} see [docs]([[Page]]) {{[[query]]: {or: [[q]]}}}",
+            "{{youtube: www.youtube.com/watch?v=a}} [a]([[p]]) {{youtube: www.youtube.com/watch?v=b}}",
+        ]
+        for string in strings:
+            with self.subTest(string=string):
+                a = BlockContent.from_string(string)
+                b = BlockContent.from_string(string, tokenize=False)
+                self.assertSameContent(a, b)
+
+    def test_unbalanced_page_refs(self):
+        strings = [
+            "[[al]([[a]])]",
+            "[[x [al]([[a]]) #tag",
+            "[[}}[a]([[p]])y]][[",
+            "[a]([[p]])text[[[[q]][al]([[a]])]]",
+            "[[[[q]]#ty]]",
+            "[[x [[y]] #t]]",
+            "#[[t]][[x#[[t]][[p]]]]#t",
+            "y]][[#t#[[t]]",
+        ]
+        for string in strings:
+            with self.subTest(string=string):
+                a = BlockContent.from_string(string)
+                b = BlockContent.from_string(string, tokenize=False)
+                self.assertSameContent(a, b)
+
+
+class TestPatterns(unittest.TestCase):
+    def test_static_patterns_compiled_once(self):
+        self.assertIs(BlockRef.get_pattern(), BlockRef.get_pattern("((abcdefghi))"))
+        self.assertIs(Url.get_pattern(validate=True), STATIC_PATTERNS[(Url, True)])
+        self.assertTrue(Attribute.validate_string("attr::"))
+        self.assertFalse(Attribute.validate_string("attr:: text"))
+
+    def test_dynamic_patterns(self):
+        pat = PageRef.get_pattern("[[a]] and [[b]]")
+        self.assertEqual(pat.findall("[[b]] [[c]] [[a]]"), ["[[b]]", "[[a]]"])
+        self.assertIsNone(PageRef.get_pattern("no page refs"))
+
+
 class TestEmphasis(unittest.TestCase):
     def test_all(self):
         string = '**something** `some code` and `more code` derp and __underlined_stuff__ and ^^highlights^^'
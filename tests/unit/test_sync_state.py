@@ -0,0 +1,116 @@
+import os
+import copy
+import shutil
+import tempfile
+import unittest
+from ankify_roam.roam import RoamGraph
+from ankify_roam.sync_state import SyncState, block_hash, note_hash
+
+
+PAGES = [
+    {"title": "page", "children": [
+        {"string": "parent", "uid": "parent000", "edit-time": 1, "children": [
+            {"string": "question ((refblock0)) #ankify", "uid": "question0", "edit-time": 2, "children": [
+                {"string": "answer", "uid": "answer000", "edit-time": 3},
+            ]},
+            {"string": "sibling", "uid": "sibling00", "edit-time": 4},
+        ]},
+    ]},
+    {"title": "other page", "children": [
+        {"string": "referenced", "uid": "refblock0", "edit-time": 5, "children": [
+            {"string": "referenced child", "uid": "refchild0", "edit-time": 6},
+        ]},
+    ]},
+]
+
+
+def question_hash(pages):
+    return block_hash(RoamGraph(pages).query_by_uid("question0"))
+
+
+def edit(uid, string):
+    "Return the pages with one block's string changed"
+    pages = copy.deepcopy(PAGES)
+    blocks = list(pages)
+    while blocks:
+        block = blocks.pop()
+        if block.get("uid") == uid:
+            block["string"] = string
+        blocks.extend(block.get("children", []))
+    return pages
+
+
+class TestBlockHash(unittest.TestCase):
+    def test_latest_edit_time(self):
+        self.assertEqual(question_hash(PAGES)[1], 6)
+
+    def test_changes(self):
+        content_hash = question_hash(PAGES)[0]
+        self.assertEqual(question_hash(copy.deepcopy(PAGES))[0], content_hash)
+        for uid in ["question0", "answer000", "parent000", "refblock0", "refchild0"]:
+            with self.subTest(uid=uid):
+                self.assertNotEqual(question_hash(edit(uid, "changed"))[0], content_hash)
+        # Blocks which aren't on the note don't change it
+        self.assertEqual(question_hash(edit("sibling00", "changed"))[0], content_hash)
+
+    def test_page_title(self):
+        pages = copy.deepcopy(PAGES)
+        pages[0]["title"] = "renamed"
+        self.assertNotEqual(question_hash(pages)[0], question_hash(PAGES)[0])
+
+    def test_page_attributes(self):
+        pages = copy.deepcopy(PAGES)
+        pages[0]["children"].insert(0, {"string": "tags:: [[ankify: deck=Default]]", "uid": "pagetags0", "edit-time": 7})
+        def attr_hash(pages, from_attr):
+            return block_hash(RoamGraph(pages).query_by_uid("question0"), from_attr=from_attr)[0]
+        pages_edited = copy.deepcopy(pages)
+        pages_edited[0]["children"][0]["string"] = "tags:: [[ankify: deck=Other]]"
+        self.assertNotEqual(attr_hash(pages_edited, True), attr_hash(pages, True))
+        self.assertEqual(attr_hash(pages_edited, False), attr_hash(pages, False))
+
+
+class TestNoteHash(unittest.TestCase):
+    def test_note_hash(self):
+        note = {"deckName": "Default", "modelName": "Roam Basic", "fields": {"Front": "a", "uid": "question0"},
+                "tags": ["ankify"], "suspend": None}
+        self.assertEqual(note_hash(dict(note, suspend=True, images=[{"filename": "a.png"}])), note_hash(note))
+        for key, value in [("deckName", "Other"), ("modelName", "Roam Cloze"),
+                           ("fields", {"Front": "b", "uid": "question0"}), ("tags", [])]:
+            with self.subTest(key=key):
+                self.assertNotEqual(note_hash(dict(note, **{key: value})), note_hash(note))
+
+
+class TestSyncState(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "state", "sync_state.json")
+
+    def test_save_and_load(self):
+        state = SyncState(self.path, {"deck": "Default"})
+        state.record("question0", "abc", 6, 123, "note")
+        state.save()
+        state = SyncState(self.path, {"deck": "Default"}).load()
+        self.assertTrue(state.is_synced("question0", "abc", 123))
+        self.assertFalse(state.is_synced("question0", "def", 123))
+        # The note was deleted or replaced in Anki
+        self.assertFalse(state.is_synced("question0", "abc", None))
+        self.assertFalse(state.is_synced("question0", "abc", 456))
+        self.assertFalse(state.is_synced("answer000", "abc", 123))
+        self.assertEqual(state.get_notes([123, 456]), {"question0": {"noteId": 123, "noteHash": "note"}})
+        self.assertEqual(state.get_notes([456]), {})
+
+    def test_settings_changed(self):
+        state = SyncState(self.path, {"deck": "Default"})
+        state.record("question0", "abc", 6, 123, "note")
+        state.save()
+        state = SyncState(self.path, {"deck": "Other"}).load()
+        self.assertEqual(state.blocks, {})
+
+    def test_unreadable(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "w") as f:
+            f.write("not json")
+        with self.assertLogs("ankify_roam.sync_state", level="WARNING"):
+            state = SyncState(self.path).load()
+        self.assertEqual(state.blocks, {})
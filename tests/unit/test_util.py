@@ -0,0 +1,25 @@
+import unittest
+import io
+import json
+from ankify_roam.util import iter_json_array
+
+
+class TestIterJsonArray(unittest.TestCase):
+    def test_items(self):
+        items = [{"title": "page", "children": [{"string": "a ]}, [b"}]}, [1, 2], "c", 1.5e10, None]
+        string = json.dumps(items, indent=1)
+        for chunk_size in [1, 3, 1000]:
+            a = list(iter_json_array(io.StringIO(string), chunk_size=chunk_size))
+            self.assertEqual(a, items)
+
+    def test_number_split_across_chunks(self):
+        a = list(iter_json_array(io.StringIO("[-25000000000.0, 12]"), chunk_size=7))
+        self.assertEqual(a, [-25000000000.0, 12])
+
+    def test_empty(self):
+        self.assertEqual(list(iter_json_array(io.StringIO(" [ ] "))), [])
+
+    def test_invalid(self):
+        for string in ["", "{}", "[1,", "[1 2]", "[1,]"]:
+            with self.assertRaises(json.JSONDecodeError):
+                list(iter_json_array(io.StringIO(string), chunk_size=2))